@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: bench_cache.py    Benchmarks for the request cache
+# Python Library
+# -----------------------
+
+from optparse import OptionParser
+import multiprocessing
+import tempfile
+import random
+import timeit
+import json
+import time
+import glob
+import os
+
+from tmdb3.cache import Cache
+from tmdb3.cache_engine import CacheObject
+
+# sample responses, as used by the tests
+SAMPLES = os.path.join(os.path.dirname(__file__), "..", "tests", "data")
+
+
+def bench_hit(sizes, number):
+    """Latency of a cache hit, against the number of cached records."""
+    print("{0:>10} {1:>14}".format("entries", "usec per hit"))
+    for size in sizes:
+        cache = Cache(engine="null")
+        cache._import(
+            [CacheObject(str(i), {"id": i}, 3600) for i in range(size)]
+        )
+        keys = [str(i) for i in range(0, size, max(size // 100, 1))]
+
+        def hits():
+            for key in keys:
+                cache.get(key)
+
+        best = min(timeit.repeat(hits, number=number, repeat=5))
+        print(
+            "{0:>10} {1:>14.2f}".format(
+                size, best / (number * len(keys)) * 1e6
+            )
+        )
+
+
+def bench_put(sizes, number):
+    """Latency of a write to the file engine, as the cache grows."""
+    print("{0:>10} {1:>14}".format("entries", "usec per put"))
+    filename = os.path.join(tempfile.mkdtemp(), "bench.cache")
+    cache = Cache(filename=filename)
+    count = 0
+    for size in sizes:
+        while count < size - number:
+            cache.put(str(count), {"id": count})
+            count += 1
+        start = time.perf_counter()
+        for i in range(number):
+            cache.put(str(count), {"id": count})
+            count += 1
+        print(
+            "{0:>10} {1:>14.2f}".format(
+                count, (time.perf_counter() - start) / number * 1e6
+            )
+        )
+    for path in glob.glob(filename + "*"):
+        os.remove(path)
+    os.rmdir(os.path.dirname(filename))
+
+
+def bench_compress(levels, number):
+    """
+    Size of the file cache, and latency of writes and of reads by another
+    cache, against the compression level, for sample TMDb responses.
+    """
+    print(
+        "{0:>10} {1:>14} {2:>14} {3:>14}".format(
+            "level", "bytes", "usec per put", "usec per get"
+        )
+    )
+    samples = []
+    for path in sorted(glob.glob(os.path.join(SAMPLES, "*.json"))):
+        with open(path) as fd:
+            samples.append(json.load(fd))
+    for level in levels:
+        filename = os.path.join(tempfile.mkdtemp(), "bench.cache")
+        writer = Cache(filename=filename, compression=level)
+        start = time.perf_counter()
+        for i in range(number):
+            for j, data in enumerate(samples):
+                writer.put("{0}.{1}".format(i, j), data)
+        put = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in glob.glob(filename + "*"))
+        reader = Cache(filename=filename)
+        start = time.perf_counter()
+        for i in range(number):
+            for j in range(len(samples)):
+                reader.get("{0}.{1}".format(i, j))
+        get = time.perf_counter() - start
+        count = number * len(samples)
+        print(
+            "{0:>10} {1:>14} {2:>14.2f} {3:>14.2f}".format(
+                level, size, put / count * 1e6, get / count * 1e6
+            )
+        )
+        for path in glob.glob(filename + "*"):
+            os.remove(path)
+        os.rmdir(os.path.dirname(filename))
+
+
+def _worker(engine, filename, keys, number, seed):
+    cache = Cache(engine, filename=filename)
+    rand = random.Random(seed)
+    for i in range(number):
+        key = str(rand.randrange(keys))
+        if (rand.random() < 0.2) or (cache.get(key) is None):
+            cache.put(key, {"id": key, "seed": seed})
+
+
+def bench_concurrent(sizes, number, engines=("file", "sqlite")):
+    """
+    Throughput of processes sharing a cache, each looking up random keys,
+    and storing any missing along with one in five of those found.
+    """
+    print("{0:>10} {1:>10} {2:>14}".format("engine", "processes", "ops/sec"))
+    for engine in engines:
+        for processes in sizes:
+            filename = os.path.join(tempfile.mkdtemp(), "bench.cache")
+            Cache(engine, filename=filename).put("0", {"id": 0})
+            workers = [
+                multiprocessing.Process(
+                    target=_worker,
+                    args=(engine, filename, 1000, number, seed),
+                )
+                for seed in range(processes)
+            ]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            print(
+                "{0:>10} {1:>10} {2:>14.0f}".format(
+                    engine, processes, processes * number / elapsed
+                )
+            )
+            for path in glob.glob(filename + "*"):
+                os.remove(path)
+            os.rmdir(os.path.dirname(filename))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(
+        usage="%prog [options] [hit|put|concurrent|compress]"
+    )
+    parser.add_option(
+        "-s",
+        "--sizes",
+        default="1000,10000,100000,200000",
+        help="Comma separated numbers of cached records, or of "
+        "processes, to test.",
+    )
+    parser.add_option(
+        "-n",
+        "--number",
+        type="int",
+        default=10,
+        help="Passes over the sampled keys per measurement, or puts "
+        "measured at each size, or operations per process.",
+    )
+    parser.add_option(
+        "-l",
+        "--levels",
+        default="0,1,3,6,9",
+        help="Comma separated compression levels to test.",
+    )
+    opts, args = parser.parse_args()
+    sizes = [int(size) for size in opts.sizes.split(",")]
+    if args and (args[0] == "put"):
+        bench_put(sizes, opts.number)
+    elif args and (args[0] == "concurrent"):
+        bench_concurrent(sizes, opts.number)
+    elif args and (args[0] == "compress"):
+        levels = [int(level) for level in opts.levels.split(",")]
+        bench_compress(levels, opts.number)
+    else:
+        bench_hit(sizes, opts.number)
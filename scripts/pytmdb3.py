@@ -19,6 +19,15 @@ if __name__ == '__main__':
                       dest="debug", help="Enables verbose debugging.")
     parser.add_option('-c', "--no-cache", action="store_true", default=False,
                       dest="nocache", help="Disables request cache.")
+    parser.add_option('--compact', action="store_true", default=False,
+                      dest="compact", help="Compacts request cache and "
+                      "exits.")
+    parser.add_option('--export', metavar="FILE", dest="export",
+                      help="Writes live records of the request cache to a "
+                      "pack file and exits.")
+    parser.add_option('--import', metavar="FILE", dest="load",
+                      help="Loads a pack file into the request cache and "
+                      "exits.")
     opts, args = parser.parse_args()
 
     if opts.version:
@@ -34,6 +43,20 @@ if __name__ == '__main__':
     else:
         set_cache(engine='file', filename='/tmp/pytmdb3.cache')
 
+    if opts.compact:
+        report = compact_cache()
+        print("Reclaimed {reclaimed} bytes, keeping {records} records, "
+              "in {seconds:.3f} seconds.".format(**report))
+        sys.exit(0)
+
+    if opts.export:
+        print("Exported {0} records.".format(export_cache(opts.export)))
+        sys.exit(0)
+
+    if opts.load:
+        print("Imported {0} records.".format(import_cache(opts.load)))
+        sys.exit(0)
+
     if opts.debug:
         request.DEBUG = True
 
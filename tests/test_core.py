@@ -6,27 +6,73 @@
 # (http://creativecommons.org/licenses/GPL/2.0/)
 # ----------------------------------------------
 
-from os.path import join, dirname, isfile
+import asyncio
+import io
+import json
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from glob import glob
+from os.path import join, dirname, isfile, getsize
 from os import remove
+from unittest import TestCase, mock
+from urllib.error import HTTPError, URLError
 from httpretty import httprettified
 
-from tests import AbstractTestTmdbCase
+from tests import AbstractTestTmdbCase, FAKE_API_KEY, LOCALDIR
 from tests.test_movies_api import test_movie_data
 
 from tmdb3 import locales as tmdb3_locales
-from tmdb3 import searchMovie
+from tmdb3 import searchMovie, set_key, set_cache, Movie
+from tmdb3 import request as tmdb3_request
 from tmdb3.tmdb_exceptions import TMDBCacheError
 from tmdb3.tmdb_api import MovieSearchResult
 from tmdb3.cache import Cache
+from tmdb3.cache_engine import CacheEngine, CacheObject, request_key
 from tmdb3.cache_file import FileEngine
+from tmdb3.cache_sqlite import SQLiteEngine
+from tmdb3.connection import ConnectionPool, AsyncConnectionPool
+from tmdb3.ratelimit import RateLimiter, ConcurrencyLimiter, RetryPolicy
+from tmdb3.tmdb_exceptions import TMDBOffline, TMDBRequestInvalid
 
 tmdb3_locales.set_locale("en", "us", True)
 tmdb3_locales.syslocale.encoding = 'utf-8'
 
 CACHE_FILE = join(dirname(__file__), 'tmdb3.cache')
+
+
+def remove_cache(filename):
+    # remove the cache manifest along with its segments
+    for path in glob(filename + '*'):
+        remove(path)
+
+
 # Remove any cache file that we could have from a failed test
-if isfile(CACHE_FILE):
-    remove(CACHE_FILE)
+remove_cache(CACHE_FILE)
+
+
+class ListEngine(CacheEngine):
+    # an engine with no bulk write path, storing records in a list
+    name = 'list'
+
+    def configure(self):
+        self.records = []
+
+    def get(self, date):
+        return [obj for obj in self.records if obj.creation > date]
+
+    def lookup(self, key):
+        return [obj for obj in self.records if obj.key == key]
+
+    def put(self, key, value, lifetime, validators=None, creation=None):
+        obj = CacheObject(key, value, lifetime, creation, validators)
+        self.expire(key)
+        self.records.append(obj)
+        return [obj]
+
+    def expire(self, key):
+        self.records = [obj for obj in self.records if obj.key != key]
 
 
 @httprettified
@@ -36,8 +82,7 @@ class TestCache(AbstractTestTmdbCase):
     cache_file = CACHE_FILE
 
     def tearDown(self):
-        if isfile(self.cache_file):
-            remove(self.cache_file)
+        remove_cache(self.cache_file)
 
     def test_cache_configure(self):
         cache = Cache(filename=self.cache_file)
@@ -55,3 +100,1054 @@ class TestCache(AbstractTestTmdbCase):
         # Here we test the reading of the cache file by requesting some info
         movie = [i for i in result if i.title == 'Star Wars'][0]
         self.assertEqual(movie.imdb, 'tt0076759')
+
+    def test_request_key(self):
+        url = 'http://api.themoviedb.org/3/movie/11?language=en&page=1'
+        key = request_key(url + '&api_key=one')
+        self.assertEqual(key, request_key(
+            'http://api.themoviedb.org/3/movie/11?api_key=two&page=1'
+            '&language=en'))
+        self.assertNotEqual(key, request_key(url + '&session_id=abc'))
+        self.assertNotIn('api_key', key)
+        req = tmdb3_request.Request('movie/11', language='en', page=1)
+        self.assertEqual(
+            req.cache_key(), req.new(language=None).new(language='en')
+            .new(page=1).cache_key())
+
+    def test_expiry_index(self):
+        cache = Cache(engine='null')
+        cache._import([CacheObject('a', 1, 0.2), CacheObject('b', 2, 60)])
+        # replacing a record leaves its old expiry behind, which must not
+        # drop the new record
+        cache._import([CacheObject('a', 3, 60)])
+        time.sleep(0.3)
+        self.assertEqual(cache.get('a'), 3)
+        self.assertEqual(cache.get('b'), 2)
+        cache._import([CacheObject('c', 4, 0)])
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(sorted(cache._data), ['a', 'b'])
+
+    def test_lazy_records(self):
+        key = 'quoted "key" \\'
+        Cache(filename=self.cache_file).put(key, {'id': 11})
+        cache = Cache(filename=self.cache_file)
+        obj = cache._engine.lookup(key)[0]
+        # only the key is parsed, until the data is used
+        self.assertEqual(obj.key, key)
+        self.assertIsNone(obj._data)
+        self.assertEqual(obj.data, {'id': 11})
+
+    def test_segments(self):
+        writer = Cache(filename=self.cache_file, segment_size=100,
+                       revalidate=0)
+        for i in range(10):
+            writer.put('expired', {'id': i}, 0)
+        first = writer._engine.segments[0]
+        time.sleep(0.1)
+        for i in range(10):
+            writer.put(str(i), {'id': i})
+        segments = writer._engine.segments
+        self.assertGreater(len(segments), 1)
+        # segments are reclaimed once all their records have expired
+        self.assertNotIn(first, segments)
+        self.assertEqual(len(glob(self.cache_file + '.*')), len(segments))
+        reader = Cache(filename=self.cache_file)
+        for i in range(10):
+            self.assertEqual(reader.get(str(i)), {'id': i})
+        self.assertIsNone(reader.get('expired'))
+
+    def test_checksum(self):
+        Cache(filename=self.cache_file).put('key', {'id': 11})
+        with open(self.cache_file + '.1', 'r+b') as fd:
+            block = fd.read()
+            fd.seek(block.index(b'{"id": 11}'))
+            fd.write(b'{"id": 12}')
+        # the damaged record is treated as missing
+        self.assertIsNone(Cache(filename=self.cache_file).get('key'))
+
+    def test_compact(self):
+        writer = Cache(filename=self.cache_file, segment_size=100)
+        reader = Cache(filename=self.cache_file)
+        for i in range(10):
+            writer.put(str(i % 4), {'id': i})
+        # expired records are only kept if they may be revalidated
+        writer.put('expired', {'id': 10}, 0)
+        writer.put('etag', {'id': 12}, 0, validators={'etag': '"12"'})
+        writer.put('last', {'id': 11})
+        self.assertEqual(reader.get('1'), {'id': 9})
+        time.sleep(0.1)
+        report = writer.compact()
+        self.assertGreater(report['reclaimed'], 0)
+        self.assertEqual(report['records'], 5)
+        self.assertLess(report['seconds'], 10)
+        self.assertEqual(len(writer._engine.segments), 2)
+        self.assertEqual(
+            len(glob(self.cache_file + '.*')), 2)
+        for i in range(6, 10):
+            self.assertEqual(writer.get(str(i % 4)), {'id': i})
+        # other caches follow the swap
+        reader._data.clear()
+        for i in range(6, 10):
+            self.assertEqual(reader.get(str(i % 4)), {'id': i})
+        self.assertEqual(reader.get('last'), {'id': 11})
+        self.assertIsNone(reader.get('expired'))
+
+    def test_upgrade_v2(self):
+        # version 2 files have no key index, and are keyed by request URL
+        url = 'http://api.themoviedb.org/3/movie/{}?api_key=one&language=en'
+        blocks = [
+            json.dumps([url.format(i), {'id': i}]).encode() for i in (11, 12)
+        ]
+        now = time.time()
+        with open(self.cache_file, 'wb') as fd:
+            fd.write(struct.pack('HH', 2, 3))
+            position = 4 + 16 * 3
+            for block in blocks:
+                fd.write(struct.pack('dII', now, 3600, position))
+                position += len(block)
+            fd.write(struct.pack('dII', 0, 0, 0))
+            fd.write(b''.join(blocks))
+        cache = Cache(filename=self.cache_file)
+        self.assertEqual(cache.get(request_key(url.format(11))), {'id': 11})
+        self.assertEqual(cache.get(request_key(url.format(12))), {'id': 12})
+        with open(self.cache_file, 'rb') as fd:
+            self.assertEqual(
+                struct.unpack('H', fd.read(2))[0], FileEngine._version)
+
+    def test_upgrade_other(self):
+        Cache(filename=self.cache_file).put('key', {'id': 11})
+        # only version 2 files were released, others are started again
+        with open(self.cache_file, 'r+b') as fd:
+            fd.write(struct.pack('H', 7))
+        cache = Cache(filename=self.cache_file)
+        self.assertIsNone(cache.get('key'))
+        cache.put('other', {'id': 12})
+        reader = Cache(filename=self.cache_file)
+        self.assertEqual(reader.get('other'), {'id': 12})
+
+    def test_compression(self):
+        path = join(LOCALDIR, 'data', 'movie_similar_star_wars_1977.json')
+        with open(path) as fd:
+            data = json.load(fd)
+        Cache(filename=self.cache_file).put('plain', data)
+        size = getsize(self.cache_file + '.1')
+        writer = Cache(filename=self.cache_file, compression=6)
+        writer.put('compressed', data)
+        self.assertLess(getsize(self.cache_file + '.1') - size, size / 2)
+        reader = Cache(filename=self.cache_file)
+        self.assertEqual(reader.get('plain'), data)
+        self.assertEqual(reader.get('compressed'), data)
+
+    def test_export_import(self):
+        pack = self.cache_file + '.pack'
+        writer = Cache(filename=self.cache_file)
+        writer.put('a', {'id': 1}, 3600)
+        writer.put('b', {'id': 2}, 3600)
+        writer.put('expired', {'id': 3}, 0)
+        exporter = Cache(filename=self.cache_file)
+        self.assertEqual(exporter.export(pack), 2)
+        # records are streamed, not kept in the index once written
+        self.assertTrue(all(
+            obj._block is None for obj in exporter._engine.index.values()))
+        created = writer._data['a'].creation
+        for engine, kwargs in (
+                ('memory', {}),
+                ('list', {}),
+                ('file', {'filename': self.cache_file + '-copy'}),
+                ('sqlite', {'filename': self.cache_file + '.sqlite'})):
+            cache = Cache(engine, **kwargs)
+            # newer than the record in the pack, which is skipped
+            cache.put('b', {'id': 4})
+            self.assertEqual(cache.load(pack, batch=1), 1)
+            self.assertEqual(cache.get('a'), {'id': 1})
+            self.assertEqual(cache.get('b'), {'id': 4})
+            self.assertIsNone(cache.get('expired'))
+            obj = cache._engine.lookup('a')[0]
+            self.assertEqual(obj.creation, created)
+            self.assertEqual(obj.lifetime, 3600)
+        with open(self.cache_file + '-copy', 'rb') as fd:
+            self.assertRaises(TMDBCacheError, Cache('null').load, fd)
+
+    def test_stats(self):
+        cache = Cache(filename=self.cache_file, revalidate=0)
+        cache.put('key', {'id': 11})
+        cache.put('expired', {'id': 12}, 0)
+        self.assertEqual(cache.get('key'), {'id': 11})
+        self.assertIsNone(cache.get('missing'))
+        stats = cache.stats(reset=True)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['puts'], 2)
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['records'], 1)
+        engine = stats['engine']
+        self.assertEqual(engine['restarts'], 1)
+        self.assertEqual(engine['records'], 2)
+        self.assertGreater(engine['bytes'], engine['live_bytes'])
+        self.assertGreater(engine['lock_seconds'], 0)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['engine']['lock_seconds'], 0)
+        self.assertEqual(stats['engine']['records'], 2)
+
+    def test_lookup_by_key(self):
+        writer = Cache(filename=self.cache_file)
+        reader = Cache(filename=self.cache_file)
+        for i in range(5):
+            writer.put(str(i), {'id': i})
+        # only the record asked for is read
+        self.assertEqual(reader.get('3'), {'id': 3})
+        self.assertEqual(list(reader._data), ['3'])
+        # and writes by other caches are seen through the generation
+        self.assertIsNone(reader.get('5'))
+        writer.put('5', {'id': 5})
+        self.assertEqual(reader.get('5'), {'id': 5})
+
+    def test_coalesce_cancelled(self):
+        cache = Cache('null')
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(10 if len(calls) == 1 else 0)
+            return {'id': len(calls)}
+
+        async def query():
+            leader = asyncio.ensure_future(cache.coalesce_async('k', fetch))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(
+                cache.coalesce_async('k', fetch))
+            await asyncio.sleep(0)
+            leader.cancel()
+            # the follower queries it in place of the leader
+            return await asyncio.wait_for(follower, 1)
+
+        self.assertEqual(asyncio.run(query()), {'id': 2})
+
+    def test_coalesce_interrupted(self):
+        cache = Cache('null')
+        started = threading.Event()
+        results = []
+
+        def interrupted():
+            started.set()
+            time.sleep(0.1)
+            raise KeyboardInterrupt
+
+        def leader():
+            try:
+                cache.coalesce('k', interrupted)
+            except KeyboardInterrupt:
+                pass
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+        results.append(cache.coalesce('k', lambda: {'id': 1}))
+        thread.join()
+        self.assertEqual(results, [{'id': 1}])
+
+    def test_lock_file_opened_once(self):
+        opened = []
+        real_open = io.open
+
+        def slow_open(path, *args):
+            if path.endswith('.lock'):
+                opened.append(path)
+                time.sleep(0.05)
+            return real_open(path, *args)
+
+        for engine, filename in (
+                ('file', self.cache_file),
+                ('sqlite', self.cache_file + '.sqlite')):
+            cache = Cache(engine, filename=filename, coalesce=True)
+            del opened[:]
+            threads = [
+                threading.Thread(target=cache._engine.lock, args=(str(i),))
+                for i in range(4)]
+            with mock.patch('io.open', slow_open):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(opened), 1)
+
+    def test_get_put_many(self):
+        for engine, kwargs in (
+                ('file', {'filename': self.cache_file}),
+                ('sqlite', {'filename': self.cache_file + '.sqlite'}),
+                ('memory', {}),
+                ('tiered', {'filename': self.cache_file + '-tiered'})):
+            writer = Cache(engine, **kwargs)
+            writer.put_many([
+                ('a', {'id': 1}, 3600),
+                ('b', {'id': 2}, 3600, {'etag': '"b"'}),
+                ('expired', {'id': 3}, 0),
+            ])
+            reader = writer if engine == 'memory' else Cache(engine, **kwargs)
+            reader.stats(reset=True)
+            self.assertEqual(
+                reader.get_many(['a', 'b', 'expired', 'missing']),
+                {'a': {'id': 1}, 'b': {'id': 2}})
+            self.assertEqual(reader._data['b'].validators, {'etag': '"b"'})
+            stats = reader.stats()
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['misses'], 2)
+
+    def test_deferred(self):
+        writer = Cache(filename=self.cache_file)
+        reader = Cache(filename=self.cache_file)
+        with writer.deferred(batch=3):
+            writer.put('a', {'id': 1})
+            writer.put('b', {'id': 2})
+            # served from memory, but not yet written
+            self.assertEqual(writer.get('a'), {'id': 1})
+            self.assertIsNone(reader.get('a'))
+            with writer.deferred():
+                writer.put('c', {'id': 3})
+            # a full batch is written right away
+            self.assertEqual(reader.get('a'), {'id': 1})
+            writer.put('d', {'id': 4})
+            self.assertEqual(reader.preload(['b', 'c', 'd']), 2)
+            # other threads write theirs right away
+            thread = threading.Thread(
+                target=writer.put, args=('e', {'id': 5}))
+            thread.start()
+            thread.join()
+            self.assertEqual(reader.get('e'), {'id': 5})
+        self.assertEqual(reader.get('d'), {'id': 4})
+        self.assertEqual(len(list(writer._engine.export())), 5)
+
+    def test_deferred_expiry(self):
+        cache = Cache(filename=self.cache_file)
+        with cache.deferred():
+            cache.put('key', {'id': 11}, lifetime=1)
+            self.assertEqual(cache.get('key'), {'id': 11})
+            with mock.patch('time.time', return_value=time.time() + 2):
+                self.assertIsNone(cache.get('key'))
+        # expired while held, so never written
+        self.assertEqual(list(cache._engine.export()), [])
+
+
+class TestSQLiteCache(TestCase):
+    cache_file = join(dirname(__file__), 'tmdb3.sqlite')
+
+    def tearDown(self):
+        remove_cache(self.cache_file)
+
+    def test_read_write(self):
+        writer = Cache('sqlite', filename=self.cache_file)
+        self.assertIsInstance(writer._engine, SQLiteEngine)
+        reader = Cache('sqlite', filename=self.cache_file)
+        writer.put('key', {'id': 11}, validators={'etag': '"v1"'})
+        self.assertEqual(reader.get('key'), {'id': 11})
+        self.assertEqual(reader._data['key'].validators, {'etag': '"v1"'})
+        writer.put('key', {'id': 12})
+        reader._data.clear()
+        self.assertEqual(reader.get('key'), {'id': 12})
+        self.assertIsNone(reader.get('missing'))
+
+    def test_expire(self):
+        cache = Cache('sqlite', filename=self.cache_file, expire_batch=2,
+                      revalidate=0)
+        for i in range(5):
+            cache.put(str(i), {'id': i}, 0.2)
+        cache.put('live', {'id': 5})
+        time.sleep(0.3)
+        self.assertEqual(cache._engine._expire(), 5)
+        self.assertIsNone(cache.get('0'))
+        report = cache.compact()
+        self.assertEqual(report['records'], 1)
+        self.assertEqual(cache.get('live'), {'id': 5})
+
+
+class TestMemoryCache(TestCase):
+    def test_entry_budget(self):
+        cache = Cache('memory', max_entries=3)
+        for i in range(3):
+            cache.put(str(i), {'id': i})
+        # reading a record makes it the most recently used
+        self.assertEqual(cache.get('0'), {'id': 0})
+        cache.put('3', {'id': 3})
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(sorted(cache._data), ['0', '2', '3'])
+        self.assertEqual(len(cache._engine.records), 3)
+
+    def test_byte_budget(self):
+        cache = Cache('memory', max_bytes=100)
+        cache.put('small', {'id': 1})
+        cache.put('large', {'data': 'x' * 100})
+        self.assertIsNone(cache.get('large'))
+        for i in range(10):
+            cache.put(str(i), {'id': i})
+        self.assertLessEqual(cache._engine.size, 100)
+        self.assertEqual(len(cache._data), len(cache._engine.records))
+        self.assertIsNone(cache.get('small'))
+        self.assertEqual(cache.get('9'), {'id': 9})
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], stats['engine']['evictions'])
+        self.assertEqual(stats['engine']['bytes'], cache._engine.size)
+
+    def test_expire(self):
+        cache = Cache('memory', revalidate=0)
+        cache.put('key', {'id': 1}, 0)
+        time.sleep(0.05)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache._engine.size, 0)
+
+
+class TestTieredCache(TestCase):
+    cache_file = CACHE_FILE
+
+    def tearDown(self):
+        remove_cache(self.cache_file)
+
+    def test_read_through(self):
+        cache = Cache('tiered', filename=self.cache_file, max_entries=2)
+        for i in range(3):
+            cache.put(str(i), {'id': i})
+        # evicted from memory, but still stored in the backend
+        self.assertNotIn('0', cache._data)
+        self.assertNotIn('0', cache._engine.l1.records)
+        self.assertEqual(cache.get('0'), {'id': 0})
+        self.assertEqual(list(cache._engine.l1.records), ['2', '0'])
+        self.assertEqual(sorted(cache._data), ['0', '2'])
+
+    def test_shared_backend(self):
+        writer = Cache('tiered', filename=self.cache_file)
+        reader = Cache('tiered', filename=self.cache_file)
+        writer.put('key', {'id': 1})
+        self.assertEqual(reader.get('key'), {'id': 1})
+        self.assertIn('key', reader._engine.l1.records)
+
+    def test_invalid_backend(self):
+        with self.assertRaises(TMDBCacheError):
+            Cache('tiered', backend='tiered')
+
+
+class TestRateLimiter(TestCase):
+    limit_file = join(dirname(__file__), 'tmdb3.ratelimit')
+
+    def tearDown(self):
+        if isfile(self.limit_file):
+            remove(self.limit_file)
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(rate=2, burst=2)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+        # bucket is empty, further tokens are reserved in order
+        self.assertAlmostEqual(limiter.reserve(), 0.5, places=1)
+        self.assertAlmostEqual(limiter.reserve(), 1.0, places=1)
+
+    def test_shared_bucket(self):
+        # limiters sharing a file, as separate processes would
+        first = RateLimiter(rate=1, burst=2, filename=self.limit_file)
+        second = RateLimiter(rate=1, burst=2, filename=self.limit_file)
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(second.reserve(), 0)
+        self.assertAlmostEqual(first.reserve(), 1.0, places=1)
+        self.assertAlmostEqual(second.reserve(), 2.0, places=1)
+
+    def test_stats(self):
+        limiter = RateLimiter(rate=20, burst=1)
+        limiter.acquire()
+        limiter.acquire()
+        limiter.observe(429, {'Retry-After': '0'})
+        stats = limiter.stats(reset=True)
+        self.assertEqual(stats['sleeps'], 1)
+        self.assertAlmostEqual(stats['seconds'], 0.05, places=2)
+        self.assertEqual(stats['pauses'], 1)
+        self.assertEqual(limiter.stats()['sleeps'], 0)
+
+    def test_disabled(self):
+        limiter = RateLimiter(rate=0)
+        for i in range(100):
+            self.assertEqual(limiter.reserve(), 0)
+
+    def test_adaptive(self):
+        limiter = RateLimiter()
+        limiter.observe(200, {
+            'X-RateLimit-Limit': '40',
+            'X-RateLimit-Remaining': '39',
+            'X-RateLimit-Reset': str(int(time.time()) + 10)})
+        self.assertEqual(limiter.burst, 40)
+        self.assertGreaterEqual(limiter.rate, 4)
+        self.assertLess(limiter.rate, 4.5)
+        # responses announcing no limit leave the bucket as it is
+        rate = limiter.rate
+        limiter.observe(200, {})
+        self.assertEqual(limiter.rate, rate)
+        self.assertEqual(limiter.burst, 40)
+        # a rate given is kept
+        limiter.configure(rate=2)
+        limiter.observe(200, {})
+        self.assertEqual(limiter.rate, 2)
+
+
+class TestRetry(TestCase):
+    def test_retry_policy(self):
+        policy = RetryPolicy(retries=2, backoff=1, maximum=4)
+        self.assertLessEqual(policy.delay(0, TMDBOffline()), 1)
+        self.assertLessEqual(policy.delay(1, TMDBOffline()), 2)
+        self.assertIsNone(policy.delay(2, TMDBOffline()))
+        self.assertIsNone(policy.delay(0, TMDBCacheError()))
+
+    def test_concurrency_limiter(self):
+        limiter = ConcurrencyLimiter(limit=8, minimum=2, maximum=9)
+        limiter.observe(200, {})
+        self.assertGreater(limiter.limit, 8)
+        limiter.observe(429, {})
+        self.assertLess(limiter.limit, 5)
+        # decreased at most once per second
+        limiter.observe(503, {})
+        self.assertGreater(limiter.limit, 4)
+        for i in range(100):
+            limiter.observe(200, {})
+        self.assertEqual(limiter.limit, 9)
+
+    def test_concurrency_handoff(self):
+        limiter = ConcurrencyLimiter(limit=1)
+
+        async def query():
+            await limiter.acquire_async()
+            waiter = asyncio.ensure_future(limiter.acquire_async())
+            cancelled = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            # a blocking request from the loop does not wait for the slot
+            with limiter.slot():
+                self.assertEqual(limiter.inflight, 1)
+            limiter.release()
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(limiter.inflight, 1)
+            limiter.release()
+
+        asyncio.run(query())
+        self.assertEqual(limiter.inflight, 0)
+        self.assertTrue(limiter.acquire())
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Keep-alive capable handler echoing the requested path as JSON."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DataHandler(StubHandler):
+    """Keep-alive capable handler serving the movie test data."""
+    paths = {
+        '/3/search/movie': 'movie_search_star_wars_1977.json',
+        '/3/movie/11': 'movie_info_star_wars_1977.json',
+        '/3/movie/11/images': 'movie_images_star_wars_1977.json',
+    }
+
+    def do_GET(self):
+        filename = self.paths[self.path.split('?')[0]]
+        with open(join(LOCALDIR, 'data', filename), 'rb') as fp:
+            body = fp.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThrottledHandler(StubHandler):
+    """Rate limits every other request, asking to retry right away."""
+    hits = 0
+
+    def do_GET(self):
+        ThrottledHandler.hits += 1
+        if ThrottledHandler.hits % 2:
+            body = b'{"status_code": 25}'
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            super(ThrottledHandler, self).do_GET()
+
+
+class SlowHandler(StubHandler):
+    """Counts the requests received, taking a while to answer each."""
+    hits = 0
+
+    def do_GET(self):
+        SlowHandler.hits += 1
+        time.sleep(0.2)
+        super(SlowHandler, self).do_GET()
+
+
+class ETagHandler(StubHandler):
+    """Tags responses with an ETag, answering 304 when it matches."""
+    hits = 0
+    modified = 0
+
+    def do_GET(self):
+        ETagHandler.hits += 1
+        if self.headers.get('If-None-Match') == '"v1"':
+            ETagHandler.modified += 1
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class NotFoundHandler(StubHandler):
+    """Answers every request with a resource not found error."""
+    hits = 0
+
+    def do_GET(self):
+        NotFoundHandler.hits += 1
+        body = b'{"status_code": 34, "status_message": "Not found."}'
+        self.send_response(404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DroppingHandler(StubHandler):
+    """Drops each connection after answering, without telling the client."""
+    hits = 0
+
+    def do_GET(self):
+        DroppingHandler.hits += 1
+        super(DroppingHandler, self).do_GET()
+        self.close_connection = True
+
+    do_POST = do_GET
+
+
+class RedirectHandler(StubHandler):
+    """
+    Redirects to /3/moved with the status given as the last part of the
+    path, where the method, body and content type sent are echoed.
+    """
+
+    def do_GET(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        sent = self.rfile.read(size).decode()
+        if self.path == '/3/moved':
+            body = json.dumps({
+                'method': self.command,
+                'body': sent,
+                'type': self.headers.get('Content-Type')}).encode()
+            self.send_response(200)
+        else:
+            body = b''
+            self.send_response(int(self.path.rsplit('/', 1)[1]))
+            self.send_header('Location', '/3/moved')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+class StubServerTestCase(TestCase):
+    """Runs a local keep-alive HTTP server for the duration of each test."""
+    handler = StubHandler
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/3/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestConnectionPool(StubServerTestCase):
+    def test_connection_reuse(self):
+        pool = ConnectionPool()
+        for i in range(5):
+            res = pool.urlopen('GET', self.url + str(i))
+            self.assertEqual(json.load(res), {'path': '/3/' + str(i)})
+        stats = pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 4)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(timeout=0)
+        pool.urlopen('GET', self.url)
+        pool.urlopen('GET', self.url)
+        stats = pool.stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['reused'], 0)
+        self.assertEqual(stats['discarded'], 1)
+
+    def test_proxy(self):
+        proxy = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        url = 'http://api.example.invalid/3/movie/11'
+        with mock.patch.dict('os.environ', http_proxy=proxy, no_proxy=''):
+            res = ConnectionPool().urlopen('GET', url)
+            self.assertEqual(json.load(res), {'path': url})
+            res = asyncio.run(AsyncConnectionPool().urlopen('GET', url))
+            self.assertEqual(json.load(res), {'path': url})
+
+
+class TestRedirect(StubServerTestCase):
+    handler = RedirectHandler
+
+    def test_redirect(self):
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        moved = {'method': 'GET', 'body': '', 'type': None}
+        pool = ConnectionPool()
+        for status in (301, 302, 303):
+            # posted forms are sent on as GET, without the form
+            res = pool.urlopen(
+                'POST', self.url + str(status), b'value=1', headers)
+            self.assertEqual(json.load(res), moved)
+            res = asyncio.run(AsyncConnectionPool().urlopen(
+                'POST', self.url + str(status), b'value=1', headers))
+            self.assertEqual(json.load(res), moved)
+        for status in (307, 308):
+            res = pool.urlopen('GET', self.url + str(status))
+            self.assertEqual(json.load(res)['method'], 'GET')
+            # the method is kept, and only followed for GET and HEAD
+            with self.assertRaises(HTTPError):
+                pool.urlopen(
+                    'POST', self.url + str(status), b'value=1', headers)
+            with self.assertRaises(HTTPError):
+                asyncio.run(AsyncConnectionPool().urlopen(
+                    'POST', self.url + str(status), b'value=1', headers))
+
+    def test_proxy_cached(self):
+        pool = ConnectionPool()
+        with mock.patch(
+                'urllib.request.getproxies', return_value={}) as getproxies:
+            # worked out once for the host, redirects included
+            for i in range(3):
+                pool.urlopen('GET', self.url + '307')
+            self.assertEqual(getproxies.call_count, 1)
+            pool.clear()
+            pool.urlopen('GET', self.url + '307')
+            self.assertEqual(getproxies.call_count, 2)
+
+
+class TestDroppedConnection(StubServerTestCase):
+    handler = DroppingHandler
+
+    def setUp(self):
+        super(TestDroppedConnection, self).setUp()
+        DroppingHandler.hits = 0
+
+    def test_retry_idempotent(self):
+        pool = ConnectionPool()
+        pool.urlopen('GET', self.url)
+        # the dropped connection is replaced, and the request sent again
+        pool.urlopen('GET', self.url)
+        self.assertEqual(DroppingHandler.hits, 2)
+        self.assertEqual(pool.stats()['created'], 2)
+
+    def test_no_retry_post(self):
+        pool = ConnectionPool()
+        pool.urlopen('GET', self.url)
+        with self.assertRaises(URLError):
+            pool.urlopen('POST', self.url, b'value=1')
+        # the server may have processed it, so it is not sent again
+        self.assertLessEqual(DroppingHandler.hits, 2)
+
+
+class ApiStubTestCase(StubServerTestCase):
+    """Points API requests at the local server, without caching."""
+
+    def setUp(self):
+        super(ApiStubTestCase, self).setUp()
+        set_key(FAKE_API_KEY)
+        set_cache(engine='null')
+        self.base_url = tmdb3_request.Request._base_url
+        tmdb3_request.Request._base_url = self.url
+
+    def tearDown(self):
+        tmdb3_request.Request._base_url = self.base_url
+        super(ApiStubTestCase, self).tearDown()
+
+
+class TestAsync(ApiStubTestCase):
+    handler = DataHandler
+
+    def test_async_search_and_load(self):
+        async def query():
+            result = searchMovie('Star Wars', year=1977)
+            titles = [movie.title async for movie in result]
+            movie = await Movie(11).load('imdb', 'images')
+            return result, titles, movie
+
+        result, titles, movie = asyncio.run(query())
+        self.assertEqual(len(titles), len(result))
+        self.assertIn('Star Wars', titles)
+        self.assertIn('imdb_id', movie._data)
+        self.assertIn('posters', movie._data)
+        self.assertEqual(movie.imdb, 'tt0076759')
+        self.assertIsInstance(movie.posters, list)
+
+
+class TestCoalescing(ApiStubTestCase):
+    handler = SlowHandler
+
+    def setUp(self):
+        super(TestCoalescing, self).setUp()
+        SlowHandler.hits = 0
+
+    def test_coalesce_threads(self):
+        results = []
+
+        def query():
+            req = tmdb3_request.Request('movie/11')
+            results.append(req.readJSON())
+
+        threads = [threading.Thread(target=query) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(SlowHandler.hits, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(r == results[0] for r in results))
+
+    def test_coalesce_async(self):
+        async def query():
+            return await asyncio.gather(*[
+                tmdb3_request.Request('movie/11').readJSONAsync()
+                for i in range(8)
+            ])
+
+        results = asyncio.run(query())
+        self.assertEqual(SlowHandler.hits, 1)
+        self.assertEqual(len(results), 8)
+
+
+class TestReadMany(ApiStubTestCase):
+    handler = StubHandler
+
+    def test_read_many(self):
+        set_cache(engine='memory')
+        requests = [
+            tmdb3_request.Request('movie/{0}'.format(i)) for i in range(3)]
+        results = tmdb3_request.read_many(requests)
+        self.assertEqual(
+            [r['path'].split('?')[0] for r in results],
+            ['/3/movie/0', '/3/movie/1', '/3/movie/2'])
+        tmdb3_request.cache.stats(reset=True)
+        self.assertEqual(tmdb3_request.read_many(requests), results)
+        self.assertEqual(tmdb3_request.cache.stats()['hits'], 3)
+
+
+class TestThrottling(ApiStubTestCase):
+    handler = ThrottledHandler
+
+    def setUp(self):
+        super(TestThrottling, self).setUp()
+        ThrottledHandler.hits = 0
+
+    def test_retry_throttled(self):
+        data = tmdb3_request.Request('movie/11').readJSON()
+        self.assertEqual(data['path'].split('?')[0], '/3/movie/11')
+        self.assertEqual(ThrottledHandler.hits, 2)
+
+    def test_retry_throttled_async(self):
+        data = asyncio.run(tmdb3_request.Request('movie/11').readJSONAsync())
+        self.assertEqual(data['path'].split('?')[0], '/3/movie/11')
+        self.assertEqual(ThrottledHandler.hits, 2)
+
+
+class TestRevalidation(ApiStubTestCase):
+    handler = ETagHandler
+
+    def setUp(self):
+        super(TestRevalidation, self).setUp()
+        ETagHandler.hits = ETagHandler.modified = 0
+        set_cache(engine='file', filename=CACHE_FILE)
+
+    def tearDown(self):
+        set_cache(engine='null')
+        remove_cache(CACHE_FILE)
+        super(TestRevalidation, self).tearDown()
+
+    def query(self):
+        req = tmdb3_request.Request('movie/11')
+        req.lifetime = 1
+        return req.readJSON()
+
+    def test_revalidate_expired(self):
+        data = self.query()
+        self.assertEqual(self.query(), data)
+        self.assertEqual(ETagHandler.hits, 1)
+        # once expired, the record is revalidated rather than downloaded
+        time.sleep(1.1)
+        self.assertEqual(self.query(), data)
+        self.assertEqual(ETagHandler.hits, 2)
+        self.assertEqual(ETagHandler.modified, 1)
+        # and its lifetime renewed
+        self.assertEqual(self.query(), data)
+        self.assertEqual(ETagHandler.hits, 2)
+
+    def test_validators_persisted(self):
+        data = self.query()
+        time.sleep(1.1)
+        # a new cache reads the expired record and its validators from file
+        cache = Cache(filename=CACHE_FILE)
+        key = tmdb3_request.Request('movie/11').cache_key()
+        self.assertIsNone(cache.get(key))
+        stale = cache.stale(key)
+        self.assertEqual(stale.data, data)
+        self.assertEqual(stale.validators, {'etag': '"v1"'})
+
+
+class TestStale(TestCase):
+    def tearDown(self):
+        tmdb3_request.stale_grace.clear()
+        tmdb3_request.cache.retain(0)
+
+    def test_serve_stale(self):
+        cache = Cache('memory')
+        cache.retain(60)
+        release = threading.Event()
+        calls = []
+
+        class Query(object):
+            lifetime = 0.1
+            grace = 60
+
+            def key(self):
+                return 'key'
+
+            def new(self):
+                return Query()
+
+            @cache.cached(key)
+            def read(self):
+                calls.append(self)
+                if len(calls) > 1:
+                    release.wait(5)
+                return len(calls)
+
+        query = Query()
+        self.assertEqual(query.read(), 1)
+        time.sleep(0.2)
+        # expired, but served at once while one refresh runs
+        self.assertEqual(query.read(), 1)
+        self.assertEqual(query.read(), 1)
+        release.set()
+        for i in range(100):
+            if cache.get('key') is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(query.read(), 2)
+        self.assertEqual(len(calls), 2)
+        # refreshed on a copy of the query
+        self.assertIs(calls[0], query)
+        self.assertIsNot(calls[1], query)
+        self.assertEqual(cache.stats()['stale'], 2)
+
+    def test_refresh_pool(self):
+        cache = Cache('memory')
+        release = threading.Event()
+        calls = []
+
+        def query():
+            calls.append(threading.current_thread())
+            release.wait(5)
+            return {}
+
+        for i in range(10):
+            cache.refresh(str(i), query)
+            # already being refreshed
+            cache.refresh(str(i), query)
+        time.sleep(0.1)
+        self.assertEqual(len(calls), Cache._refreshers)
+        release.set()
+        cache._refresher.shutdown()
+        self.assertEqual(len(calls), 10)
+        self.assertLessEqual(len(set(calls)), Cache._refreshers)
+
+    def test_endpoints(self):
+        set_key(FAKE_API_KEY)
+        tmdb3_request.set_stale(60, 'configuration')
+        tmdb3_request.set_stale(600, 'movie/*')
+        tmdb3_request.set_stale(30, '*')
+        tmdb3_request.set_stale(0, 'latest/movie')
+        Request = tmdb3_request.Request
+        self.assertEqual(Request('configuration').grace, 60)
+        self.assertEqual(Request('movie/11').grace, 600)
+        # the path Movie.latest() queries
+        self.assertEqual(Request('latest/movie').grace, 0)
+        self.assertEqual(Request('person/1').grace, 30)
+        # records are kept for the longest grace
+        self.assertEqual(tmdb3_request.cache.grace, 600)
+
+
+class TestLifetimes(TestCase):
+    def setUp(self):
+        set_key(FAKE_API_KEY)
+        self.lifetimes = dict(tmdb3_request.lifetimes)
+
+    def tearDown(self):
+        tmdb3_request.lifetimes.clear()
+        tmdb3_request.lifetimes.update(self.lifetimes)
+        set_cache(engine='null')
+
+    def test_policy(self):
+        Request = tmdb3_request.Request
+        self.assertEqual(Request('configuration').lifetime, 60 * 60 * 24)
+        self.assertEqual(Request('movie/11').lifetime, 60 * 60)
+        set_cache(engine='null', lifetimes={
+            'movie/*': 60, 'movie/popular': 600, 'movie/*/images': 0})
+        self.assertEqual(Request('movie/11').lifetime, 60)
+        self.assertEqual(Request('movie/popular').lifetime, 600)
+        self.assertEqual(Request('movie/11/images').lifetime, 0)
+        self.assertEqual(Request('person/1').lifetime, 60 * 60)
+
+
+class TestNegativeCaching(ApiStubTestCase):
+    handler = NotFoundHandler
+
+    def setUp(self):
+        super(TestNegativeCaching, self).setUp()
+        NotFoundHandler.hits = 0
+        set_cache(engine='file', filename=CACHE_FILE)
+
+    def tearDown(self):
+        tmdb3_request.set_negative(300)
+        set_cache(engine='null')
+        remove_cache(CACHE_FILE)
+        super(TestNegativeCaching, self).tearDown()
+
+    def query(self):
+        return tmdb3_request.Request('movie/0').readJSON()
+
+    def test_not_found_cached(self):
+        for i in range(3):
+            self.assertRaises(TMDBRequestInvalid, self.query)
+        self.assertEqual(NotFoundHandler.hits, 1)
+        key = tmdb3_request.Request('movie/0').cache_key()
+        obj = tmdb3_request.cache._data[key]
+        self.assertEqual(obj.lifetime, 300)
+        with self.assertRaises(TMDBRequestInvalid):
+            asyncio.run(tmdb3_request.Request('movie/0').readJSONAsync())
+        self.assertEqual(NotFoundHandler.hits, 1)
+
+    def test_disabled(self):
+        tmdb3_request.set_negative(0)
+        for i in range(2):
+            self.assertRaises(TMDBRequestInvalid, self.query)
+        self.assertEqual(NotFoundHandler.hits, 2)
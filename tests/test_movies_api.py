@@ -6,7 +6,11 @@
 # (http://creativecommons.org/licenses/GPL/2.0/)
 # ----------------------------------------------
 
-from httpretty import httprettified
+import json
+from os.path import join
+from unittest import mock
+
+from httpretty import httprettified, HTTPretty
 from datetime import date
 
 from tmdb3.tmdb_api import (
@@ -19,15 +23,16 @@ from tmdb3.tmdb_api import (
     Studio,
 )
 from tmdb3 import (
+    fetch_many,
     discoverMovie,
     searchMovie,
     searchMovieWithYear,
     Collection,
     Movie,
 )
-from tmdb3.tmdb_exceptions import TMDBImageSizeError
+from tmdb3.tmdb_exceptions import TMDBImageSizeError, TMDBRequestInvalid
 from tmdb3 import locales as tmdb3_locales
-from tests import AbstractTestTmdbCase
+from tests import AbstractTestTmdbCase, LOCALDIR, get_json_result
 
 tmdb3_locales.set_locale("en", "us", True)
 tmdb3_locales.syslocale.encoding = 'utf-8'
@@ -60,6 +65,14 @@ test_movie_data = {
         'movie_trailers_star_wars_1977.json',
         '{base_url}movie/11/trailers?language=en&api_key={api}'
     ),
+    'movie_invalid': (
+        'movie_invalid_id.json',
+        '{base_url}movie/0?language=en&api_key={api}'
+    ),
+    'movie_invalid_images': (
+        'movie_invalid_id.json',
+        '{base_url}movie/0/images?api_key={api}'
+    ),
     'movie_similar': (
         'movie_similar_star_wars_1977.json',
         '{base_url}movie/11/similar_movies?api_key={api}&language=en&page=1'
@@ -171,3 +184,92 @@ class TestMovie(AbstractTestTmdbCase):
         self.assertIsInstance(movie.studios[0], Studio)
 
         self.assertIsInstance(movie.similar, MovieSearchResult)
+
+
+@httprettified
+class TestMovieFetchMany(AbstractTestTmdbCase):
+    mock_data = test_movie_data
+    mock_requests = [
+        'movie_info', 'movie_images', 'movie_invalid', 'movie_invalid_images'
+    ]
+
+    def test_fetch_many(self):
+        result = fetch_many(Movie, [11, 0, 11], fields=['title', 'posters'])
+        self.assertEqual(len(result), 3)
+        self.assertIsNone(result[1])
+        self.assertIsInstance(result.errors[1], TMDBRequestInvalid)
+        for movie in (result[0], result[2]):
+            self.assertIsInstance(movie, Movie)
+            self.assertIn('title', movie._data)
+            self.assertIn('posters', movie._data)
+            self.assertEqual(movie.title, 'Star Wars')
+            self.assertIsInstance(movie.posters[0], Poster)
+
+    def test_fetch_many_invalid_field(self):
+        self.assertRaises(TypeError, fetch_many, Movie, [11], ['similar'])
+
+
+@httprettified
+class TestMoviePrefetch(AbstractTestTmdbCase):
+    mock_data = test_movie_data
+    mock_requests = []
+
+    def setUp(self):
+        super(TestMoviePrefetch, self).setUp()
+        # images are queried in the language of the movie, so are folded
+        patcher = mock.patch.object(
+            tmdb3_locales.LocaleBase, 'fallthrough', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the main query with images appended to the response
+        data = json.loads(get_json_result(
+            join(LOCALDIR, 'data', 'movie_info_star_wars_1977.json')))
+        data['images'] = json.loads(get_json_result(
+            join(LOCALDIR, 'data', 'movie_images_star_wars_1977.json')))
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            '{}movie/11?append_to_response=images&language=en'
+            '&api_key={}'.format(self.base_url, self.api_key),
+            body=json.dumps(data)
+        )
+
+    def test_prefetch(self):
+        movie = Movie(11, prefetch=['images'])
+        self.assertEqual(len(HTTPretty.latest_requests), 1)
+        self.assertEqual(
+            HTTPretty.last_request.querystring['append_to_response'],
+            ['images'])
+        self.assertEqual(movie.title, 'Star Wars')
+        self.assertIsInstance(movie.posters[0], Poster)
+        self.assertIsInstance(movie.backdrops[0], Backdrop)
+        self.assertEqual(len(HTTPretty.latest_requests), 1)
+
+    def test_prefetch_fallthrough(self):
+        # images are queried in every language, and not in that of the
+        # movie, so are queried on their own
+        tmdb3_locales.LocaleBase.fallthrough = True
+        for name in ('movie_info', 'movie_images'):
+            mock_json_file, mock_url = self.mock_data[name]
+            HTTPretty.register_uri(
+                HTTPretty.GET,
+                mock_url.format(base_url=self.base_url, api=self.api_key),
+                body=get_json_result(join(LOCALDIR, 'data', mock_json_file))
+            )
+        movie = Movie(11, prefetch=['images'])
+        for request in HTTPretty.latest_requests:
+            self.assertNotIn('append_to_response', request.querystring)
+        self.assertEqual(HTTPretty.last_request.path.split('?')[0],
+                         '/3/movie/11/images')
+        self.assertNotIn('language', HTTPretty.last_request.querystring)
+        count = len(HTTPretty.latest_requests)
+        self.assertIsInstance(movie.posters[0], Poster)
+        self.assertEqual(len(HTTPretty.latest_requests), count)
+
+    def test_prefetch_invalid(self):
+        self.assertRaises(TypeError, Movie, 11, prefetch=['similar'])
+
+    def test_fetch_many_prefetch(self):
+        result = fetch_many(
+            Movie, [11], fields=['title', 'posters'], prefetch=True)
+        self.assertEqual(len(HTTPretty.latest_requests), 1)
+        self.assertIsInstance(result[0].posters[0], Poster)
@@ -22,10 +22,25 @@ from .tmdb_api import (
     Episode,
     Season,
 )
-from .request import set_key, set_cache
+from .request import (
+    set_key,
+    set_cache,
+    compact_cache,
+    export_cache,
+    import_cache,
+    get_stats,
+    read_many,
+    set_pool,
+    set_ratelimit,
+    set_concurrency,
+    set_retry,
+    set_stale,
+    set_negative,
+)
 from .locales import get_locale, set_locale
 from .tmdb_auth import get_session, set_session
 from .cache_engine import CacheEngine
+from .batch import fetch_many
 from .tmdb_exceptions import *
 
 __title__ = (
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: batch.py
+# Python Library
+# Purpose: Populate many Element objects concurrently, running their
+#          pollers on a pool of worker threads
+# -----------------------
+
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+
+from .util import ElementType, get_pollers
+from .request import cache
+from .tmdb_exceptions import *
+
+
+class BatchResult(list):
+    """
+    List of populated Element objects, in the order their ids were given.
+    Elements that failed to populate are replaced by None, with the raised
+    exception stored in the `errors` dictionary under the index of the
+    failed id.
+    """
+
+    def __init__(self, iterable=(), errors=None):
+        super(BatchResult, self).__init__(iterable)
+        self.errors = errors or {}
+
+
+def _populated(element, name):
+    return all(
+        field in element._data for field in getattr(element, name).lookup
+    )
+
+
+def fetch_many(cls, ids, fields=None, workers=8, locale=None, prefetch=False):
+    """
+    Create and populate an Element of the given class for each id,
+    running the required pollers concurrently on a pool of threads.
+        cls     -- Element class to create, such as Movie or Person
+        ids     -- iterable of ids. classes initialized with multiple
+                   arguments, such as Season, take a tuple per element
+        fields  -- (optional) names of the data fields to populate, or
+                   of the queries to run, such as 'images'. if not
+                   given, every poller of the class is run
+        workers -- (optional) number of worker threads
+        locale  -- (optional) locale to create the elements with
+        prefetch -- (optional) fold the queries of sub-resources into
+                   the main query of each element, using
+                   append_to_response, as with Element.prefetch()
+    Errors raised while populating an element are collected in the
+    `errors` attribute of the returned BatchResult rather than raised.
+    Cached responses are read from the cache engine together, and the
+    responses queried are written to it together once all have run.
+    """
+    if not isinstance(cls, ElementType):
+        raise TypeError("fetch_many() requires an Element class")
+    pollers = get_pollers(cls, fields)
+    append = {}
+    if prefetch:
+        appendable = dict(
+            (name, key) for key, name in cls._append_to_response.items()
+        )
+        append = dict(
+            (appendable[name], name) for name in pollers if name in appendable
+        )
+        if append:
+            pollers = ["_populate"] + [
+                name
+                for name in pollers
+                if (name not in appendable) and (name != "_populate")
+            ]
+
+    elements = []
+    errors = {}
+    for index, id in enumerate(ids):
+        args = id if isinstance(id, tuple) else (id,)
+        try:
+            elements.append(cls(*args, locale=locale))
+        except Exception as e:
+            elements.append(None)
+            errors[index] = e
+
+    jobs = []
+    for index, element in enumerate(elements):
+        if element is None:
+            continue
+        for name in pollers:
+            poller = getattr(element, name)
+            subs = {}
+            if name == "_populate":
+                subs = dict(
+                    (key, getattr(element, sub))
+                    for key, sub in append.items()
+                    if not _populated(element, sub)
+                )
+            if not subs and _populated(element, name):
+                # already populated, no need to query again
+                continue
+            jobs.append((index, poller, subs))
+
+    # read the cached responses of every query together, rather than one
+    # lookup per query, and write those queried together once done
+    keys = []
+    for index, poller, subs in jobs:
+        try:
+            folded, separate = poller.fold(subs)
+            reqs = poller.requests(folded)
+            for sub in separate.values():
+                reqs.extend(sub.requests())
+        except Exception:
+            # raised again once the poller is run
+            continue
+        keys.extend(req.cache_key() for req in reqs if req.lifetime != 0)
+    cache.preload(keys)
+
+    with cache.deferred(), ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            # each worker runs in a copy of the context, to add to the
+            # deferred batch
+            (index, pool.submit(contextvars.copy_context().run, poller, subs))
+            for index, poller, subs in jobs
+        ]
+        for index, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.setdefault(index, e)
+
+    return BatchResult(
+        [None if i in errors else e for i, e in enumerate(elements)], errors
+    )
@@ -7,15 +7,69 @@
 # Purpose: Caching framework to store TMDb API results
 # -----------------------
 
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import contextlib
+import functools
+import itertools
+import threading
+import asyncio
+import heapq
 import time
 
 from .tmdb_exceptions import *
-from .cache_engine import Engines
+from .cache_engine import Engines, CacheObject
+from .cache_pack import write_pack, read_pack, batches
 
 from .cache_null import *
 from .cache_file import *
+from .cache_sqlite import *
+from .cache_memory import *
+from .cache_tiered import *
 
-DEBUG = False
+
+class Abandoned(Exception):
+    """Raised to threads waiting on a query its leader gave up on."""
+
+
+class Flight(object):
+    """
+    A query in progress, which other threads asking for the same record
+    wait on to share its result.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._data = None
+        self._error = None
+
+    def abandon(self):
+        self.fail(Abandoned())
+
+    def land(self, data):
+        self._data = data
+        self._event.set()
+
+    def fail(self, error):
+        self._error = error
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._data
+
+
+class Deferral(object):
+    """
+    Records held by a deferred context, until they are written to the
+    engine together.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.records = {}
 
 
 class Cache(object):
@@ -23,7 +77,12 @@ class Cache(object):
     This class implements a cache framework, allowing selecting of a
     pluggable engine. The framework stores data in a key/value manner,
     along with a lifetime, after which data will be expired and
-    pulled fresh next time it is requested from the cache.
+    pulled fresh next time it is requested from the cache. Expired
+    records carrying validators (ETag, Last-Modified) are retained for
+    a further `revalidate` seconds, so they may be revalidated with a
+    conditional request rather than downloaded again. All expired records
+    are retained for `grace` seconds, so they may be served while they
+    are refreshed in the background.
 
     This class defines a wrapper to be used with query functions. The
     wrapper will automatically cache the inputs and outputs of the
@@ -31,62 +90,515 @@ class Cache(object):
     subsequent calls with those inputs.
     """
 
+    _refreshers = 4  # threads refreshing expired records
+
     def __init__(self, engine=None, *args, **kwargs):
         self._engine = None
         self._data = {}
+        self._expiry = []
+        self._order = itertools.count()
         self._age = 0
-        self._rate_limiter = []
+        self._lock = threading.RLock()
+        self._flights = {}
+        self._refreshing = set()
+        self._refresher = None
+        self._tasks = set()
+        # the batch of the deferred context entered, if any. it is carried
+        # into worker threads started with a copy of the context
+        self._deferral = contextvars.ContextVar("deferral", default=None)
+        self._deferrals = set()
+        self._counters = self._zero()
+        self.revalidate = 60 * 60 * 24
+        self.grace = 0
         self.configure(engine, *args, **kwargs)
 
+    @staticmethod
+    def _zero():
+        return dict.fromkeys(
+            ("hits", "misses", "stale", "puts", "evictions", "expirations"),
+            0,
+        )
+
+    def _retention(self, validators=True):
+        # seconds expired records are kept, to be revalidated or served
+        # while they are refreshed
+        return max(self.revalidate if validators else 0, self.grace)
+
+    def _deadline(self, obj):
+        # time a record is dropped at. validators are only looked at once
+        # the record has expired, so records need not be parsed to be
+        # indexed
+        deadline = obj.creation + obj.lifetime
+        if deadline <= time.time():
+            deadline += self._retention(obj.validators)
+        return deadline
+
     def _import(self, data=None):
         if data is None:
             data = self._engine.get(self._age)
+        now = time.time()
         for obj in sorted(data, key=lambda x: x.creation):
-            self._rate_limiter.append(obj.creation)
-            if len(self._rate_limiter) > 30:
-                self._rate_limiter.pop(0)
-            if not obj.expired:
+            deadline = self._deadline(obj)
+            if deadline > now:
                 self._data[obj.key] = obj
+                heapq.heappush(
+                    self._expiry, (deadline, next(self._order), obj)
+                )
                 self._age = max(self._age, obj.creation)
+            else:
+                self._counters["expirations"] += 1
+                self._engine.expire(obj.key)
+        if len(self._expiry) > 2 * len(self._data) + 64:
+            # mostly replaced records, rebuild rather than let it grow
+            self._reindex()
+
+    def _reindex(self):
+        self._expiry = [
+            (self._deadline(obj), next(self._order), obj)
+            for obj in self._data.values()
+        ]
+        heapq.heapify(self._expiry)
 
     def _expire(self):
-        for k, v in list(self._data.items()):
-            if v.expired:
-                del self._data[k]
+        # pop records off the expiry index as their deadlines pass. records
+        # that have since been replaced are no longer in the data, and are
+        # simply discarded
+        now = time.time()
+        while self._expiry and (self._expiry[0][0] <= now):
+            obj = heapq.heappop(self._expiry)[2]
+            if self._data.get(obj.key) is not obj:
+                continue
+            deadline = self._deadline(obj)
+            if deadline > now:
+                # kept to be revalidated
+                heapq.heappush(
+                    self._expiry, (deadline, next(self._order), obj)
+                )
+            else:
+                del self._data[obj.key]
+                self._counters["expirations"] += 1
+                self._engine.expire(obj.key)
+
+    def _evict(self, obj):
+        # called by engines with bounded storage, as records are evicted
+        with self._lock:
+            if self._data.get(obj.key) is obj:
+                del self._data[obj.key]
+                self._counters["evictions"] += 1
 
     def configure(self, engine, *args, **kwargs):
         if engine is None:
             engine = "file"
         elif engine not in Engines:
             raise TMDBCacheError("Invalid cache engine specified: " + engine)
-        self._engine = Engines[engine](self)
-        self._engine.configure(*args, **kwargs)
+        with self._lock:
+            self.revalidate = kwargs.pop("revalidate", self.revalidate)
+            self._reindex()
+            # held records are written to the engine they were put in
+            for deferral in self._deferrals:
+                self._flush(deferral)
+            self._engine = Engines[engine](self)
+            self._engine.configure(*args, **kwargs)
+
+    def retain(self, grace):
+        """
+        Keep expired records for grace seconds, so they may be served
+        while they are refreshed.
+        """
+        with self._lock:
+            self.grace = grace
+            self._reindex()
 
-    def put(self, key, data, lifetime=60 * 60 * 12):
+    def put(self, key, data, lifetime=60 * 60 * 12, validators=None):
         # pull existing data, so cache will be fresh when written back out
         if self._engine is None:
             raise TMDBCacheError("No cache engine configured")
-        self._expire()
-        self._import(self._engine.put(key, data, lifetime))
+        with self._lock:
+            self._counters["puts"] += 1
+            self._expire()
+            deferral = self._deferral.get()
+            if deferral is not None:
+                obj = CacheObject(key, data, lifetime, None, validators)
+                self._defer(deferral, obj)
+                return
+            self._import(
+                self._engine.put(key, data, lifetime, validators=validators)
+            )
 
-    def get(self, key):
+    def put_many(self, items):
+        """
+        Store many records at once, given as (key, data, lifetime) or
+        (key, data, lifetime, validators) tuples, written to the engine
+        under a single lock or transaction.
+        """
         if self._engine is None:
             raise TMDBCacheError("No cache engine configured")
-        self._expire()
-        if key not in self._data:
-            self._import()
+        objs = []
+        for item in items:
+            key, data, lifetime = item[:3]
+            validators = item[3] if len(item) > 3 else None
+            objs.append(CacheObject(key, data, lifetime, None, validators))
+        with self._lock:
+            self._counters["puts"] += len(objs)
+            self._expire()
+            deferral = self._deferral.get()
+            if deferral is not None:
+                for obj in objs:
+                    self._defer(deferral, obj)
+                return
+            self._import(self._engine.put_many(objs))
+
+    @contextlib.contextmanager
+    def deferred(self, batch=1000):
+        """
+        Hold records put while the context is entered, and write them to
+        the engine together as it is left, or each time batch records are
+        held, rather than one write each. Held records are served from
+        memory meanwhile, but are not seen by other processes until they
+        are written. Nested contexts share the batch of the outermost.
+        Records put by other threads are not held, unless those threads
+        run in a copy of the context, as the workers of fetch_many do.
+        """
+        if self._deferral.get() is not None:
+            yield self
+            return
+        deferral = Deferral(batch)
+        token = self._deferral.set(deferral)
+        with self._lock:
+            self._deferrals.add(deferral)
         try:
-            return self._data[key].data
+            yield self
+        finally:
+            self._deferral.reset(token)
+            with self._lock:
+                self._deferrals.discard(deferral)
+                self._flush(deferral)
+
+    def _defer(self, deferral, obj):
+        deferral.records[obj.key] = obj
+        self._data[obj.key] = obj
+        heapq.heappush(
+            self._expiry, (self._deadline(obj), next(self._order), obj)
+        )
+        if len(deferral.records) >= deferral.size:
+            self._flush(deferral)
+
+    def _flush(self, deferral):
+        # write the held records still current, and replace them in memory
+        # with those the engine stored. any it skipped are looked up again
+        # when used
+        objs = [
+            obj
+            for obj in deferral.records.values()
+            if self._data.get(obj.key) is obj
+        ]
+        deferral.records = {}
+        if not objs:
+            return
+        stored = self._engine.put_many(objs)
+        for obj in objs:
+            if self._data.get(obj.key) is obj:
+                del self._data[obj.key]
+        self._import(stored)
+
+    def compact(self):
+        """
+        Reclaim storage taken by expired and replaced records, returning
+        a dictionary of the bytes reclaimed, records kept, and seconds
+        spent.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        return self._engine.compact()
+
+    def export(self, fileobj):
+        """
+        Write the live records of the cache to a pack, given as a filename
+        or a binary file object, which may be loaded into a cache of any
+        engine. Returns the number of records written.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        # streamed from the engine, so a large cache is never held in
+        # memory all at once
+        objs = (obj for obj in self._engine.export() if not obj.expired)
+        return write_pack(objs, fileobj)
+
+    def load(self, fileobj, batch=1000):
+        """
+        Store the records of a pack, keeping the time they were created
+        and their lifetime, and return the number stored. Records are
+        written to the engine a batch at a time, and any that have expired,
+        or are older than those already stored, are skipped.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        count = 0
+        live = (obj for obj in read_pack(fileobj) if not obj.expired)
+        for objs in batches(live, batch):
+            with self._lock:
+                stored = self._engine.put_many(objs)
+                self._counters["puts"] += len(stored)
+                self._import(stored)
+            count += len(stored)
+        return count
+
+    def stats(self, reset=False):
+        """
+        Return a dictionary of the hits, misses, puts, evictions and
+        expirations counted by the cache, the records it holds, and the
+        statistics of its engine, optionally resetting the counters.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        with self._lock:
+            stats = dict(self._counters)
+            stats["records"] = len(self._data)
+            stats["engine"] = self._engine.stats(reset)
+            if reset:
+                self._counters = self._zero()
+        return stats
+
+    def _lookup(self, key):
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        with self._lock:
+            self._expire()
+            if (key not in self._data) or self._data[key].expired:
+                # another process may have stored a fresh copy
+                self._import(self._engine.lookup(key))
+            return self._data.get(key)
+
+    def _lookup_many(self, keys):
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        keys = list(keys)
+        with self._lock:
+            self._expire()
+            missing = [
+                key
+                for key in keys
+                if (key not in self._data) or self._data[key].expired
+            ]
+            if missing:
+                # read from the engine together
+                self._import(self._engine.lookup_many(missing))
+            return dict(
+                (key, self._data[key]) for key in keys if key in self._data
+            )
+
+    def get_many(self, keys):
+        """
+        Return a dictionary of the data of the live records stored under
+        any of the given keys, looking up those missing from memory with
+        a single read of the engine.
+        """
+        keys = set(keys)
+        objs = self._lookup_many(keys)
+        hits = {}
+        for key, obj in objs.items():
+            if not obj.expired:
+                hits[key] = obj.data
+        with self._lock:
+            self._counters["hits"] += len(hits)
+            self._counters["misses"] += len(keys) - len(hits)
+            for key in hits:
+                self._engine.hit(key)
+        return hits
+
+    def preload(self, keys):
+        """
+        Look up the records stored under the given keys with a single read
+        of the engine, so they are then served from memory by get(). The
+        records are not counted as hits until they are read. Returns the
+        number of live records found.
+        """
+        objs = self._lookup_many(keys)
+        return sum(1 for obj in objs.values() if not obj.expired)
+
+    def get(self, key):
+        obj = self._lookup(key)
+        try:
+            if not obj.expired:
+                data = obj.data
+                with self._lock:
+                    self._counters["hits"] += 1
+                    self._engine.hit(key)
+                return data
+        except:
+            pass
+        # no cache data, so we're going to query
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def stale(self, key):
+        """
+        Return the expired record stored under key, if it carries
+        validators to revalidate it with, or None.
+        """
+        obj = self._lookup(key)
+        try:
+            if obj.expired and obj.validators:
+                return obj
         except:
-            # no cache data, so we're going to query
-            # wait to ensure proper rate limiting
-            if len(self._rate_limiter) == 30:
-                w = 10 - (time.time() - self._rate_limiter.pop(0))
-                if w > 0:
-                    if DEBUG:
-                        print("rate limiting - waiting {0} seconds".format(w))
-                    time.sleep(w)
-            return None
+            pass
+        return None
+
+    def get_stale(self, key, grace):
+        """
+        Return the data of the record stored under key, if it expired less
+        than grace seconds ago, or None. Used after a miss from get(), so
+        the record is not looked up again.
+        """
+        with self._lock:
+            obj = self._data.get(key)
+            try:
+                if obj.expired and (obj.creation + obj.lifetime + grace) > (
+                    time.time()
+                ):
+                    self._counters["stale"] += 1
+                    return obj.data
+            except:
+                pass
+        return None
+
+    def refresh(self, key, func):
+        """
+        Call func on a background thread to query an expired record,
+        unless it is already being refreshed. Refreshes run on a small
+        pool of threads, queueing once all are busy. Errors are dropped,
+        leaving the expired record to be served until the next refresh.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._refresher is None:
+                self._refresher = ThreadPoolExecutor(
+                    max_workers=self._refreshers,
+                    thread_name_prefix="tmdb3-refresh",
+                )
+
+        def run():
+            try:
+                self.coalesce(key, func)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._refresher.submit(run)
+
+    def refresh_async(self, key, func):
+        """
+        As refresh(), querying the record on a task of the running event
+        loop. func must return an awaitable.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        async def run():
+            try:
+                await self.coalesce_async(key, func)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        # tasks are only weakly held by the loop
+        task = asyncio.ensure_future(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def coalesce(self, key, func):
+        """
+        Call func to query a missing record, unless the same key is
+        already being queried by another thread, in which case wait for
+        and share its result instead. If the engine supports it, queries
+        are also coalesced with other processes.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            try:
+                return flight.wait()
+            except Abandoned:
+                # the leader was interrupted, so query it ourselves
+                return self.coalesce(key, func)
+
+        try:
+            with self._engine.lock(key) as locked:
+                data = None
+                if locked:
+                    # another process may have queried it while we waited
+                    data = self.get(key)
+                if data is None:
+                    data = func()
+        except Exception as e:
+            flight.fail(e)
+            raise
+        except BaseException:
+            # interrupted, such as by KeyboardInterrupt. followers are
+            # released to query it themselves rather than left waiting
+            flight.abandon()
+            raise
+        else:
+            flight.land(data)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return data
+
+    async def coalesce_async(self, key, func):
+        """
+        Awaitable coalesce, sharing queries between the tasks of an event
+        loop. func must return an awaitable.
+        """
+        flight = (asyncio.get_running_loop(), key)
+        with self._lock:
+            future = self._flights.get(flight)
+            leader = future is None
+            if leader:
+                future = self._flights[flight] = asyncio.Future()
+        if not leader:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # the follower itself was cancelled
+                    raise
+            # the leader was cancelled, so query it ourselves
+            return await self.coalesce_async(key, func)
+
+        try:
+            data = await func()
+        except asyncio.CancelledError:
+            # such as by a timeout. followers are released to query it
+            # themselves rather than left waiting
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved, in case nobody was waiting
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(data)
+        finally:
+            with self._lock:
+                del self._flights[flight]
+        return data
 
     def cached(self, callback):
         """
@@ -95,6 +607,13 @@ class Cache(object):
         """
         return self.Cached(self, callback)
 
+    def cached_async(self, callback):
+        """
+        Returns a decorator, as with cached(), for use with coroutine
+        functions. The decorated function must be awaited.
+        """
+        return self.CachedAsync(self, callback)
+
     class Cached(object):
         def __init__(self, cache, callback, func=None, inst=None):
             self.cache = cache
@@ -132,16 +651,77 @@ class Cache(object):
                 key = self.callback()
                 data = self.cache.get(key)
                 if data is None:
-                    data = self.func(*args, **kwargs)
-                    if hasattr(self.inst, "lifetime"):
-                        self.cache.put(key, data, self.inst.lifetime)
+                    data = self._stale(key)
+                    query = self if data is None else self._fresh()
+                    fetch = functools.partial(
+                        query._fetch, key, *args, **kwargs
+                    )
+                    if data is not None:
+                        self.cache.refresh(key, fetch)
                     else:
-                        self.cache.put(key, data)
+                        data = self.cache.coalesce(key, fetch)
                 return data
 
+        def _stale(self, key):
+            # expired data may be served while it is refreshed, for as long
+            # as the request allows
+            grace = getattr(self.inst, "grace", 0)
+            if not grace:
+                return None
+            return self.cache.get_stale(key, grace)
+
+        def _fresh(self):
+            # refreshes run in the background on a copy of the instance,
+            # rather than sharing the state of the caller's one
+            new = getattr(self.inst, "new", None)
+            if new is None:
+                return self
+            return getattr(new(), self.__name__)
+
+        def _fetch(self, key, *args, **kwargs):
+            return self._store(key, self.func(*args, **kwargs))
+
+        def _store(self, key, data):
+            validators = getattr(self.inst, "validators", None)
+            # a response may be given a lifetime of its own
+            lifetime = getattr(self.inst, "response_lifetime", None)
+            if lifetime is None:
+                lifetime = getattr(self.inst, "lifetime", None)
+            if lifetime is not None:
+                self.cache.put(key, data, lifetime, validators=validators)
+            else:
+                self.cache.put(key, data, validators=validators)
+            return data
+
         def __get__(self, inst, owner):
             if inst is None:
                 return self
             func = self.func.__get__(inst, owner)
             callback = self.callback.__get__(inst, owner)
             return self.__class__(self.cache, callback, func, inst)
+
+    class CachedAsync(Cached):
+        def __call__(self, *args, **kwargs):
+            if self.func is None:
+                # decorator is waiting to be given a function
+                return super(Cache.CachedAsync, self).__call__(*args, **kwargs)
+            return self._call(*args, **kwargs)
+
+        async def _call(self, *args, **kwargs):
+            if self.inst.lifetime == 0:
+                # lifetime of zero means never cache
+                return await self.func(*args, **kwargs)
+            key = self.callback()
+            data = self.cache.get(key)
+            if data is None:
+                data = self._stale(key)
+                query = self if data is None else self._fresh()
+                fetch = functools.partial(query._fetch, key, *args, **kwargs)
+                if data is not None:
+                    self.cache.refresh_async(key, fetch)
+                else:
+                    data = await self.cache.coalesce_async(key, fetch)
+            return data
+
+        async def _fetch(self, key, *args, **kwargs):
+            return self._store(key, await self.func(*args, **kwargs))
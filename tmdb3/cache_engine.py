@@ -7,9 +7,34 @@
 # Purpose: Base cache engine class for collecting registered engines
 # -----------------------
 
+import urllib.parse
+import hashlib
 import time
 from weakref import ref
 
+# parameters that do not affect the response, and are left out of keys
+_UNKEYED = frozenset(["api_key"])
+
+
+def request_key(url):
+    """
+    Return the cache key for a request URL, a hash of its host, path and
+    parameters. Parameters are sorted, so the key does not depend on the
+    order they were given in, and the API key is left out, so rotating it
+    does not invalidate the cache. Hashing keeps any remaining secrets,
+    such as session ids, out of the stored keys.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = sorted(
+        (k, v)
+        for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if k not in _UNKEYED
+    )
+    canonical = "{0}{1}?{2}".format(
+        parts.netloc, parts.path, urllib.parse.urlencode(query)
+    )
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
 
 class Engines(object):
     """
@@ -48,9 +73,11 @@ class CacheEngineType(type):
 
 class CacheEngine(object, metaclass=CacheEngineType):
     name = "unspecified"
+    _counters = ()  # names of the counters kept by the engine
 
     def __init__(self, parent):
         self.parent = ref(parent)
+        self.counters = dict.fromkeys(self._counters, 0)
 
     def configure(self):
         raise RuntimeError
@@ -58,23 +85,129 @@ class CacheEngine(object, metaclass=CacheEngineType):
     def get(self, date):
         raise RuntimeError
 
-    def put(self, key, value, lifetime):
+    def lookup(self, key):
+        """
+        Return the stored records for the given key. Engines without an
+        index by key return every record stored since last read.
+        """
+        return self.get(self.parent()._age)
+
+    def lookup_many(self, keys):
+        """
+        Return the stored records for many keys at once. Engines without a
+        bulk read path look up each key in turn.
+        """
+        if type(self).lookup is CacheEngine.lookup:
+            # without an index, a single read returns them all
+            return self.lookup(None)
+        objs = []
+        for key in keys:
+            objs.extend(self.lookup(key))
+        return objs
+
+    def put(self, key, value, lifetime, validators=None, creation=None):
+        """
+        Store a record, created now unless a creation time is given, and
+        return those stored.
+        """
         raise RuntimeError
 
+    def put_many(self, objs):
+        """
+        Store many records at once, keeping their creation times, and
+        return those stored. Records older than one already stored under
+        the same key are skipped. Engines without a bulk write path store
+        each record in turn.
+        """
+        stored = []
+        for obj in objs:
+            if obj.expired:
+                continue
+            if any(
+                (old.key == obj.key) and (old.creation >= obj.creation)
+                for old in self.lookup(obj.key)
+            ):
+                continue
+            stored.extend(
+                self.put(
+                    obj.key,
+                    obj.data,
+                    obj.lifetime,
+                    obj.validators,
+                    obj.creation,
+                )
+            )
+        return stored
+
+    def export(self):
+        """
+        Generate every record stored, for copying to another cache. This
+        is called without holding the cache lock, which engines take as
+        they need it, so records may be handed out one at a time rather
+        than all held in memory at once.
+        """
+        with self.parent()._lock:
+            objs = self.get(0)
+        for obj in objs:
+            yield obj
+
     def expire(self, key):
         raise RuntimeError
 
+    def compact(self):
+        """
+        Reclaim storage taken by expired and replaced records, returning
+        a dictionary of the bytes reclaimed, records kept, and seconds
+        spent. Engines without persistent storage have nothing to do.
+        """
+        return {"reclaimed": 0, "records": 0, "seconds": 0}
+
+    def hit(self, key):
+        """Note a record was read, for engines evicting by recency."""
+        pass
+
+    def stats(self, reset=False):
+        """
+        Return a dictionary of the counters kept by the engine, along with
+        figures on its storage, optionally resetting the counters to zero.
+        """
+        stats = dict(self.counters)
+        if reset:
+            self.counters = dict.fromkeys(self._counters, 0)
+        return stats
+
+    def lock(self, key):
+        """
+        Return a context manager holding a lock on the given key across
+        processes, while a missing record is being queried. Entering it
+        returns whether a lock was actually taken, so the caller knows to
+        check whether another process has stored the record meanwhile.
+        """
+        return NoLock()
+
+
+class NoLock(object):
+    """Context manager for engines without cross-process locking."""
+
+    def __enter__(self):
+        return False
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
 
 class CacheObject(object):
     """
-    Cache object class, containing one stored record.
+    Cache object class, containing one stored record, along with any
+    validators (ETag, Last-Modified) used to revalidate it once expired.
     """
 
-    def __init__(self, key, data, lifetime=0, creation=None):
+    def __init__(self, key, data, lifetime=0, creation=None, validators=None):
         self.key = key
         self.data = data
         self.lifetime = lifetime
         self.creation = creation if creation is not None else time.time()
+        self.validators = validators or {}
 
     def __len__(self):
         return len(self.data)
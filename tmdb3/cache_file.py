@@ -9,46 +9,110 @@
 #          access.
 # -----------------------
 
+import contextlib
+import threading
+import tempfile
+import hashlib
 import struct
+import mmap
 import errno
+import zlib
 import json
+import time
 import os
 import io
 
-from io import StringIO
+from weakref import ref
 
 from .tmdb_exceptions import *
-from .cache_engine import CacheEngine, CacheObject
+
+from .cache_engine import CacheEngine, CacheObject, NoLock, request_key
 
 ####################
 # Cache File Format
 # -----------------
+# manifest, at the cache filename
 # cache version         (2) unsigned short
-# slot count            (2) unsigned short
-# slot 0: timestamp     (8) double
-# slot 0: lifetime      (4) unsigned int
-# slot 0: seek point    (4) unsigned int
-# slot 1: timestamp
-# slot 1: lifetime          index slots are IDd by their query date and
-# slot 1: seek point        are filled incrementally forwards. lifetime
-#   ....                    is how long after query date before the item
-#   ....                    expires, and seek point is the location of the
-# slot N-2: timestamp       start of data for that entry. 256 empty slots
-# slot N-2: lifetime        are pre-allocated, allowing fast updates.
-# slot N-2: seek point      when all slots are filled, the cache file is
-# slot N-1: timestamp       rewritten from scratch to add more slots.
-# slot N-1: lifetime
-# slot N-1: seek point
-# block 1               (?) ASCII
-# block 2
-#    ....                   blocks are just simple ASCII text, generated
-#    ....                   as independent objects by the JSON encoder
-# block N-2
-# block N-1
+# (padding)             (2)
+# dictionary size       (4) unsigned int
+# generation            (8) unsigned long long
+# segment count         (8) unsigned long long
+# segment 0             (8) unsigned long long
+# segment 1                 segments are numbered, and stored in files
+#   ....                    named after the cache file with the number
+# segment N-1               as suffix. the last segment is appended to,
+#                           until it grows past the configured size and
+#                           a new one is started. generation is
+#                           incremented whenever the list changes.
+# dictionary            (?) preset dictionary for compressed records,
+#                           kept with the log it was used to write
+#
+# segment
+# record 0: timestamp   (8) double
+# record 0: key hash    (8) unsigned long long
+# record 0: lifetime    (4) unsigned int
+# record 0: checksum    (4) unsigned int
+# record 0: size        (8) unsigned long long
+# record 0: block       (?) ASCII, or compressed
+# record 1: timestamp
+#   ....                    records are appended to the end of the log,
+# record N-1: block         and are IDd by the hash of their key, a later
+#                           record replacing any earlier one with the same
+#                           key. lifetime is how long after query date
+#                           before the item expires, and checksum is the
+#                           CRC-32 of the block as stored. blocks are just
+#                           simple ASCII text, generated as independent
+#                           objects by the JSON encoder, and compressed
+#                           with zlib using the preset dictionary if that
+#                           makes them any smaller. the top bit of the
+#                           size is set for compressed blocks, and the
+#                           next for blocks carrying validators, so they
+#                           may be retained without reading the block.
 #
 ####################
 
 
+# preset dictionary, of strings common to TMDb responses as they are
+# encoded in blocks. zlib finds the strings nearest the end quickest, so
+# the most common are given last
+_ZDICT = (
+    '{"cast_id": "character": ""credit_id": ""crew": [{"department": "'
+    '"job": "Director", '
+    '"Directing", "Writing", "Production", "Sound", "Camera", '
+    '"Editing", "Art", "Costume & Make-Up", "Visual Effects", '
+    '"known_for_department": "Acting", "profile_path": "/'
+    '"gender": 2, "order": "status_code": "status_message": "'
+    '"base_url": "http://image.tmdb.org/t/p/", '
+    '"secure_base_url": "https://image.tmdb.org/t/p/", '
+    '"w92", "w154", "w185", "w300", "w342", "w500", "w780", "original"], '
+    '"belongs_to_collection": {"id": "budget": "homepage": "https://www.'
+    '"imdb_id": "tt"production_companies": [{"id": "logo_path": "/'
+    '"production_countries": [{"iso_3166_1": "US", '
+    '"name": "United States of America"}], "revenue": "runtime": '
+    '"spoken_languages": [{"iso_639_1": "en", '
+    '"name": "English"}], "status": "Released", "tagline": "'
+    '"created_by": [], "episode_run_time": ["in_production": '
+    '"last_air_date": ""networks": [{"name": ""number_of_episodes": '
+    '"number_of_seasons": "seasons": [{"air_date": ""episode_count": '
+    '"season_number": "type": "Scripted", '
+    '{"id": 28, "name": "Action"}, {"id": 12, "name": "Adventure"}, '
+    '{"id": 16, "name": "Animation"}, {"id": 35, "name": "Comedy"}, '
+    '{"id": 80, "name": "Crime"}, {"id": 18, "name": "Drama"}, '
+    '{"id": 14, "name": "Fantasy"}, {"id": 27, "name": "Horror"}, '
+    '{"id": 878, "name": "Science Fiction"}, '
+    '{"id": 53, "name": "Thriller"}], "genres": ["page": 1, "results": ['
+    '"total_pages": "total_results": "first_air_date": ""name": "'
+    '"original_name": ""origin_country": ["US"], "adult": false, '
+    '"backdrop_path": "/.jpg", "genre_ids": ['
+    '"original_language": "en", "original_title": ""overview": ""popularity": '
+    '"poster_path": "/.jpg", "release_date": ""title": "'
+    '"video": false, "vote_average": "vote_count": {"id": "iso_639_1": null, '
+    '{"aspect_ratio": 1.7777777777777777, "file_path": "/'
+    '.jpg", "height": 1080, "iso_639_1": "en", '
+    '"vote_average": 0, "vote_count": 0, "width": 1920}, '
+).encode()
+
+
 def _donothing(*args, **kwargs):
     pass
 
@@ -83,6 +147,25 @@ try:
             fcntl.flock(self.fileobj, fcntl.LOCK_UN)
             return suppress
 
+    class RangeLock(object):
+        """
+        Context manager to lock a single byte of a file, at the given
+        offset, for the duration the object exists. Unlike Flock, this
+        allows many independent locks to be held on one file.
+        """
+
+        def __init__(self, fileobj, offset):
+            self.fileobj = fileobj
+            self.offset = offset
+
+        def __enter__(self):
+            fcntl.lockf(self.fileobj, fcntl.LOCK_EX, 1, self.offset)
+            return True
+
+        def __exit__(self, exc_type, exc_value, exc_tb):
+            fcntl.lockf(self.fileobj, fcntl.LOCK_UN, 1, self.offset)
+            return False
+
     def parse_filename(filename):
         if "$" in filename:
             # replace any environmental variables
@@ -96,7 +179,6 @@ try:
         # return path with temp directory prepended
         return "/tmp/" + filename
 
-
 except ImportError:
     import msvcrt
 
@@ -120,6 +202,21 @@ except ImportError:
             msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_UNLCK, self.size)
             return suppress
 
+    class RangeLock(object):
+        def __init__(self, fileobj, offset):
+            self.fileobj = fileobj
+            self.offset = offset
+
+        def __enter__(self):
+            self.fileobj.seek(self.offset)
+            msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_LOCK, 1)
+            return True
+
+        def __exit__(self, exc_type, exc_value, exc_tb):
+            self.fileobj.seek(self.offset)
+            msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_UNLCK, 1)
+            return False
+
     def parse_filename(filename):
         if "%" in filename:
             # replace any environmental variables
@@ -139,46 +236,127 @@ except ImportError:
         return os.path.expandvars(os.path.join("%TEMP%", filename))
 
 
+def key_hash(key):
+    """Return the 64 bit hash of a key, used to index it in the file."""
+    return struct.unpack("Q", hashlib.sha1(key.encode()).digest()[:8])[0]
+
+
 class FileCacheObject(CacheObject):
-    _struct = struct.Struct("dII")  # double and two ints
-    #                               # timestamp, lifetime, position
+    _struct = struct.Struct("dQIIQ")  # timestamp, key hash, lifetime,
+    #                                 # checksum, and size
+    _compressed = 1 << 63  # size flag for compressed blocks
+    _validated = 1 << 62  # size flag for blocks carrying validators
 
     @classmethod
-    def fromFile(cls, fd):
-        dat = cls._struct.unpack(fd.read(cls._struct.size))
-        obj = cls(None, None, dat[1], dat[0])
-        obj.position = dat[2]
+    def fromHeader(cls, header, segment, position):
+        creation, keyhash, lifetime, checksum, size = header
+        obj = cls(None, None, lifetime, creation)
+        obj.checksum = checksum
+        obj.validators = None
+        obj.keyhash = keyhash
+        obj.segment = segment
+        obj.position = position
+        obj.compressed = bool(size & cls._compressed)
+        obj.validated = bool(size & cls._validated)
+        obj.size = size & ~(cls._compressed | cls._validated)
         return obj
 
     def __init__(self, *args, **kwargs):
         self._key = None
         self._data = None
+        self._validators = None
+        self._keyhash = None
         self._size = None
-        self._buff = StringIO()
+        self._block = None
+        self._stored = None
+        self.checksum = None
+        self.compressed = False
+        self._hasvalidators = None
         super(FileCacheObject, self).__init__(*args, **kwargs)
 
+    @property
+    def block(self):
+        # the record as stored, JSON encoded
+        if self._block is None:
+            if (self._key is None) or (self._data is None):
+                raise RuntimeError
+            block = [self.key, self.data]
+            if self.validators:
+                block.append(self.validators)
+            self._block = json.dumps(block).encode()
+        return self._block
+
+    @property
+    def validated(self):
+        # whether the record carries validators, known from the header
+        # for records read from the log
+        if self._hasvalidators is None:
+            return bool(self.validators)
+        return self._hasvalidators
+
+    @validated.setter
+    def validated(self, value):
+        self._hasvalidators = value
+
+    @property
+    def stored(self):
+        # the block as written to the file
+        if self._stored is None:
+            self._stored = self.block
+        return self._stored
+
     @property
     def size(self):
         if self._size is None:
-            self._buff.seek(0, 2)
-            size = self._buff.tell()
-            if size == 0:
-                if (self._key is None) or (self._data is None):
-                    raise RuntimeError
-                json.dump([self.key, self.data], self._buff)
-                self._size = self._buff.tell()
-            self._size = size
+            self._size = len(self.stored)
         return self._size
 
     @size.setter
     def size(self, value):
         self._size = value
 
+    @property
+    def keyhash(self):
+        if self._keyhash is None:
+            self._keyhash = key_hash(self.key)
+        return self._keyhash
+
+    @keyhash.setter
+    def keyhash(self, value):
+        self._keyhash = value
+
+    def _parse(self):
+        # blocks hold the key and data, followed by any validators
+        block = json.loads(self._block)
+        self._data = block[1]
+        self._validators = block[2] if len(block) > 2 else {}
+
+    def _scankey(self):
+        # parse only the key from the start of the block, finding the
+        # closing quote of the string, leaving the data to be parsed when
+        # it is first used
+        end = 2
+        while True:
+            end = self._block.index(b'"', end)
+            start = end
+            while self._block[start - 1] == 0x5C:
+                # quote escaped by a backslash, unless it was escaped too
+                start -= 1
+            if (end - start) % 2 == 0:
+                break
+            end += 1
+        key = json.loads(self._block[1:end] + b'"')
+        if key.startswith(("http://", "https://")):
+            # keyed by URL in older files, migrated to the canonical key
+            # as the file is read, and stored once it is next rewritten
+            key = request_key(key)
+        return key
+
     @property
     def key(self):
         if self._key is None:
             try:
-                self._key, self._data = json.loads(self._buff.getvalue())
+                self._key = self._scankey()
             except:
                 pass
         return self._key
@@ -190,47 +368,131 @@ class FileCacheObject(CacheObject):
     @property
     def data(self):
         if self._data is None:
-            self._key, self._data = json.loads(self._buff.getvalue())
+            self._parse()
         return self._data
 
     @data.setter
     def data(self, value):
         self._data = value
 
-    def load(self, fd):
-        fd.seek(self.position)
-        self._buff.seek(0)
-        self._buff.write(fd.read(self.size).decode())
+    @property
+    def validators(self):
+        if self._validators is None:
+            self._parse()
+        return self._validators
 
-    def dumpslot(self, fd):
-        pos = fd.tell()
-        fd.write(
-            self._struct.pack(self.creation, self.lifetime, self.position)
-        )
+    @validators.setter
+    def validators(self, value):
+        self._validators = value
+
+    def compress(self, level, zdict):
+        # compress the block, keeping it as is unless that is any smaller
+        if zdict:
+            compressor = zlib.compressobj(level, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(level)
+        stored = compressor.compress(self.block) + compressor.flush()
+        if len(stored) < len(self.block):
+            self._stored = stored
+            self._size = len(stored)
+            self.compressed = True
 
-    def dumpdata(self, fd):
-        self.size
-        fd.seek(self.position)
-        fd.write(self._buff.getvalue().encode())
+    def load(self, view, zdict=None):
+        # the slice is the only copy made of the record, and is parsed
+        # lazily as its key and data are used
+        start, end = self.position, self.position + self.size
+        block = view[start:end]
+        if (self.checksum is not None) and (
+            zlib.crc32(block) != self.checksum
+        ):
+            raise TMDBCacheError("Cache record failed checksum")
+        if self.compressed:
+            try:
+                if zdict:
+                    decompressor = zlib.decompressobj(zdict=zdict)
+                else:
+                    decompressor = zlib.decompressobj()
+                block = decompressor.decompress(block) + decompressor.flush()
+            except zlib.error:
+                raise TMDBCacheError("Cache record failed to decompress")
+        self._block = block
+
+    def header(self):
+        # the fields of the record header, with the flags held in the size
+        size = self.size
+        if self.compressed:
+            size |= self._compressed
+        if self.validated:
+            size |= self._validated
+        return self.creation, self.keyhash, self.lifetime, self.checksum, size
+
+    def dump(self, fd):
+        self.checksum = zlib.crc32(self.stored)
+        fd.write(self._struct.pack(*self.header()) + self.stored)
 
 
 class FileEngine(CacheEngine):
-    """Simple file-backed engine."""
+    """
+    File-backed engine, storing records in an append-only log split over
+    segment files, which are listed in a small manifest kept at the cache
+    filename. Records are indexed by a hash of their key as the log is
+    read, so a lookup only reads the record asked for, and only records
+    appended since the log was last read need to be scanned. Records
+    are optionally compressed, at the zlib level given by `compression`,
+    using a preset dictionary of strings common to TMDb responses.
+    """
 
     name = "file"
-    _struct = struct.Struct("HH")  # two shorts for version and count
-    _version = 2
+    _struct = struct.Struct("HxxIQQ")  # version, dictionary size,
+    #                                  # generation, and segments
+    _segment = struct.Struct("Q")  # segment number
+    _version = 3
+    _counters = ("rotations", "compactions", "restarts", "lock_seconds")
 
     def __init__(self, parent):
         super(FileEngine, self).__init__(parent)
         self.configure(None)
 
-    def configure(self, filename, preallocate=256):
-        self.preallocate = preallocate
+    def configure(
+        self,
+        filename,
+        segment_size=2**24,
+        coalesce=False,
+        compact_interval=None,
+        preallocate=None,
+        compression=0,
+    ):
+        # preallocate sized the slot table of older versions, and is only
+        # accepted for compatibility
+        self.segment_size = segment_size
+        self.compression = compression
+        self.coalesce = coalesce
         self.cachefile = filename
-        self.size = 0
-        self.free = 0
-        self.age = 0
+        self.lockfd = None
+        self.files = {}
+        self.maps = {}
+        self._reset()
+        if hasattr(self, "_stop"):
+            self._stop.set()
+        self._stop = threading.Event()
+        if compact_interval:
+            threading.Thread(
+                target=_compactor,
+                args=(ref(self), self._stop, compact_interval),
+                daemon=True,
+            ).start()
+
+    def _reset(self):
+        # forget everything read from the log
+        for number in list(self.files):
+            self._drop(number)
+        self.generation = None
+        self.segments = []
+        self.zdict = None
+        self.sealed = set()
+        self.scanned = {}
+        self.expires = {}
+        self.index = {}
 
     def _init_cache(self):
         # only run this once
@@ -247,13 +509,15 @@ class FileEngine(CacheEngine):
             # seems to have read fine, make sure we have write access
             if not os.access(self.cachefile, os.W_OK):
                 raise TMDBCacheWriteError(self.cachefile)
+            self._upgrade()
 
         except IOError as e:
             if e.errno == errno.ENOENT:
                 # file does not exist, create a new one
                 try:
                     self._open("w+b")
-                    self._write([])
+                    with self._locked(Flock.LOCK_EX):
+                        self._create([])
                 except IOError as e:
                     if e.errno == errno.ENOENT:
                         # directory does not exist
@@ -275,24 +539,107 @@ class FileEngine(CacheEngine):
         self._init_cache()
         self._open("r+b")
 
-        with Flock(self.cachefd, Flock.LOCK_SH):
+        with self._locked(Flock.LOCK_SH):
             # return any new objects in the cache
-            return self._read(date)
+            self._refresh()
+            return self._load(
+                obj for obj in self.index.values() if obj.creation > date
+            )
 
-    def put(self, key, value, lifetime):
+    def lookup(self, key):
         self._init_cache()
         self._open("r+b")
 
-        with Flock(self.cachefd, Flock.LOCK_EX):
-            newobjs = self._read(self.age)
-            newobjs.append(FileCacheObject(key, value, lifetime))
+        with self._locked(Flock.LOCK_SH):
+            # only records appended since last read are scanned, so a miss
+            # costs little more than a read of the manifest
+            self._refresh()
+            obj = self.index.get(key_hash(key))
+            return self._load([obj] if obj is not None else [])
 
-            # this will cause a new file object to be opened with the proper
-            # access mode, however the Flock should keep the old object open
-            # and properly locked
+    def lookup_many(self, keys):
+        self._init_cache()
+        self._open("r+b")
+
+        with self._locked(Flock.LOCK_SH):
+            # the manifest is read once, for all of the keys
+            self._refresh()
+            objs = (self.index.get(key_hash(key)) for key in set(keys))
+            return self._load(obj for obj in objs if obj is not None)
+
+    def put(self, key, value, lifetime, validators=None, creation=None):
+        self._init_cache()
+        self._open("r+b")
+        obj = FileCacheObject(key, value, lifetime, creation, validators)
+
+        with self._locked(Flock.LOCK_EX):
+            self._refresh()
+            if not self.segments:
+                # unreadable manifest, start again
+                self._create([])
+            self._append(obj)
+            return [obj]
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        # hold the lock on the manifest, counting the time spent waiting
+        # for and holding it
+        start = time.perf_counter()
+        try:
+            with Flock(self.cachefd, operation):
+                yield
+        finally:
+            self.counters["lock_seconds"] += time.perf_counter() - start
+
+    def put_many(self, objs):
+        # all records are appended under a single lock
+        self._init_cache()
+        self._open("r+b")
+        stored = []
+
+        with self._locked(Flock.LOCK_EX):
+            self._refresh()
+            if not self.segments:
+                self._create([])
+            for obj in objs:
+                prev = self.index.get(key_hash(obj.key))
+                if (prev is not None) and (prev.creation >= obj.creation):
+                    continue
+                obj = FileCacheObject(
+                    obj.key,
+                    obj.data,
+                    int(obj.lifetime),
+                    obj.creation,
+                    obj.validators,
+                )
+                self._append(obj)
+                stored.append(obj)
+        return stored
+
+    def export(self):
+        # records are read one at a time, from copies of the index taken
+        # under the lock, so the index is not left holding every record
+        # read once the export is done
+        self._init_cache()
+        parent = self.parent()
+        with parent._lock:
             self._open("r+b")
-            self._write(newobjs)
-            return newobjs
+            with self._locked(Flock.LOCK_SH):
+                self._refresh()
+                objs = [
+                    FileCacheObject.fromHeader(
+                        obj.header(), obj.segment, obj.position
+                    )
+                    for obj in self.index.values()
+                ]
+        for obj in objs:
+            with parent._lock:
+                # segments may have been removed by compaction meanwhile
+                if self._file(obj.segment) is None:
+                    continue
+                loaded = self._load([obj])
+            for record in loaded:
+                yield record
 
     def _open(self, mode="r+b"):
         # enforce binary operation
@@ -305,105 +652,437 @@ class FileEngine(CacheEngine):
             pass  # catch issue of no cachefile yet opened
         self.cachefd = io.open(self.cachefile, mode)
 
-    def _read(self, date):
-        try:
-            self.cachefd.seek(0)
-            version, count = self._struct.unpack(
-                self.cachefd.read(self._struct.size)
+    def _segpath(self, number):
+        return "{0}.{1}".format(self.cachefile, number)
+
+    def _file(self, number):
+        # open segment file, or None if it has been removed
+        fd = self.files.get(number)
+        if fd is None:
+            try:
+                fd = io.open(self._segpath(number), "r+b")
+            except FileNotFoundError:
+                return None
+            self.files[number] = fd
+        return fd
+
+    def _map(self, number):
+        # map the segment for reading, mapping it again if it has grown
+        # since it was last mapped. segments are only ever appended to,
+        # so existing mappings stay valid
+        fd = self._file(number)
+        size = os.fstat(fd.fileno()).st_size
+        view = self.maps.get(number)
+        if (view is None) or (len(view) < size):
+            if view is not None:
+                view.close()
+            view = self.maps[number] = mmap.mmap(
+                fd.fileno(), size, access=mmap.ACCESS_READ
             )
-            if version != self._version:
-                # old version, break out and well rewrite when finished
-                raise Exception
-
-            self.size = count
-            cache = []
-            while count:
-                # loop through storage definitions
-                obj = FileCacheObject.fromFile(self.cachefd)
-                cache.append(obj)
-                count -= 1
+        return view
 
-        except:
-            # failed to read information, so just discard it and return empty
-            self.size = 0
-            self.free = 0
-            return []
+    def _drop(self, number):
+        # close a segment that is no longer part of the log
+        view = self.maps.pop(number, None)
+        if view is not None:
+            view.close()
+        fd = self.files.pop(number, None)
+        if fd is not None:
+            fd.close()
+        for keyhash, obj in list(self.index.items()):
+            if obj.segment == number:
+                del self.index[keyhash]
+        self.sealed.discard(number)
+        self.scanned.pop(number, None)
+        self.expires.pop(number, None)
+
+    def _retained(self, obj):
+        # expired records are kept while they may still be revalidated,
+        # or served while being refreshed
+        retention = self.parent()._retention(obj.validated)
+        return obj.creation + obj.lifetime + retention > time.time()
+
+    def _expires(self, number, obj):
+        # note when the last record of a segment expires, apart for records
+        # with and without validators, as they are retained for different
+        # times
+        plain, validated = self.expires.get(number, (0, 0))
+        if obj.validated:
+            validated = max(validated, obj.creation + obj.lifetime)
+        else:
+            plain = max(plain, obj.creation + obj.lifetime)
+        self.expires[number] = (plain, validated)
 
-        # get end of file
-        self.cachefd.seek(0, 2)
-        position = self.cachefd.tell()
-        newobjs = []
-        emptycount = 0
-
-        # walk backward through all, collecting new content and populating size
-        while len(cache):
-            obj = cache.pop()
-            if obj.creation == 0:
-                # unused slot, skip
-                emptycount += 1
-            elif obj.expired:
-                # object has passed expiration date, no sense processing
+    def _dead(self, number, now):
+        # whether every record of a segment is past retention
+        plain, validated = self.expires.get(number, (0, 0))
+        retention = self.parent()._retention
+        return (plain + retention(False) < now) and (
+            validated + retention(True) < now
+        )
+
+    def _load(self, objs):
+        # read the blocks of the given records that are still retained,
+        # dropping any that cannot be parsed
+        loaded = []
+        for obj in objs:
+            if not self._retained(obj):
                 continue
-            elif obj.creation > date:
-                # used slot with new data, process
-                obj.size, position = position - obj.position, obj.position
-                newobjs.append(obj)
-                # update age
-                self.age = max(self.age, obj.creation)
-            elif len(newobjs):
-                # end of new data, break
-                break
+            try:
+                obj.load(self._map(obj.segment), self.zdict)
+            except TMDBCacheError:
+                # damaged record, treat as missing
+                continue
+            if obj.key is not None:
+                loaded.append(obj)
+        return loaded
 
-        # walk forward and load new content
-        for obj in newobjs:
-            obj.load(self.cachefd)
+    def _readmanifest(self):
+        self.cachefd.seek(0)
+        version, dictsize, generation, count = self._struct.unpack(
+            self.cachefd.read(self._struct.size)
+        )
+        if version != self._version:
+            raise TMDBCacheError
+        segments = [
+            number
+            for number, in self._segment.iter_unpack(
+                self.cachefd.read(count * self._segment.size)
+            )
+        ]
+        if len(segments) != count:
+            raise TMDBCacheError
+        zdict = self.zdict
+        if generation != self.generation:
+            # the log may have been started again, with another dictionary
+            zdict = self.cachefd.read(dictsize)
+            if len(zdict) != dictsize:
+                raise TMDBCacheError
+        return generation, segments, zdict
 
-        self.free = emptycount
-        return newobjs
+    def _writemanifest(self):
+        self.cachefd.seek(0)
+        self.cachefd.write(
+            self._struct.pack(
+                self._version,
+                len(self.zdict),
+                self.generation,
+                len(self.segments),
+            )
+        )
+        for number in self.segments:
+            self.cachefd.write(self._segment.pack(number))
+        self.cachefd.write(self.zdict)
+        self.cachefd.truncate()
+        self.cachefd.flush()
+
+    def _refresh(self):
+        # read the manifest, dropping segments that have been removed, and
+        # scan any records appended to the log since it was last read
+        try:
+            generation, segments, self.zdict = self._readmanifest()
+        except (struct.error, TMDBCacheError):
+            # failed to read information, so just discard it. the next
+            # write will start the log again
+            self._reset()
+            return
+        if (generation, segments) != (self.generation, self.segments):
+            for number in set(self.files) - set(segments):
+                self._drop(number)
+            self.generation = generation
+            self.segments = segments
 
-    def _write(self, data):
-        if self.free and (self.size != self.free):
-            # we only care about the last data point, since the rest are
-            # already stored in the file
-            data = data[-1]
+        if not self.segments:
+            return
+        for number in self.segments[:-1]:
+            if number not in self.sealed:
+                # no longer appended to, so only scanned once more
+                self._scan(number)
+                self.sealed.add(number)
+        self._scan(self.segments[-1])
 
-            # determine write position of data in cache
-            self.cachefd.seek(0, 2)
-            end = self.cachefd.tell()
-            data.position = end
+    def _scan(self, number):
+        # index the records appended to a segment since it was last read,
+        # stopping at any record still being written
+        fd = self._file(number)
+        if fd is None:
+            return
+        offset = self.scanned.get(number, 0)
+        size = os.fstat(fd.fileno()).st_size
+        if size <= offset:
+            return
+        view = self._map(number)
+        header = FileCacheObject._struct
+        while offset + header.size <= size:
+            obj = FileCacheObject.fromHeader(
+                header.unpack_from(view, offset), number, offset + header.size
+            )
+            if obj.position + obj.size > size:
+                break
+            prev = self.index.get(obj.keyhash)
+            if (prev is None) or (prev.creation <= obj.creation):
+                self.index[obj.keyhash] = obj
+            self._expires(number, obj)
+            offset = obj.position + obj.size
+        self.scanned[number] = offset
 
-            # write incremental update to free slot
-            self.cachefd.seek(4 + 16 * (self.size - self.free))
-            data.dumpslot(self.cachefd)
-            data.dumpdata(self.cachefd)
+    def _append(self, obj):
+        # write a record to the end of the log, starting a new segment once
+        # the current one has reached the size limit
+        if self.compression and not obj.compressed:
+            obj.compress(self.compression, self.zdict)
+        number = self.segments[-1]
+        end = self.scanned.get(number, 0)
+        if end and (end + obj.size > self.segment_size):
+            number = self._rotate()
+            end = 0
+        fd = self._file(number)
+        if os.fstat(fd.fileno()).st_size != end:
+            # discard any partial record left by an interrupted write
+            fd.truncate(end)
+        fd.seek(end)
+        obj.dump(fd)
+        fd.flush()
+        obj.segment = number
+        obj.position = end + FileCacheObject._struct.size
+        self.scanned[number] = obj.position + obj.size
+        self._expires(number, obj)
+        self.index[obj.keyhash] = obj
 
-        else:
-            # rewrite cache file from scratch
-            # pull data from parent cache
-            data.extend(list(self.parent()._data.values()))
-            data.sort(key=lambda x: x.creation)
-            # write header
-            size = len(data) + self.preallocate
+    def _rotate(self):
+        # seal the current segment and start a new one, removing segments
+        # whose records have all expired past revalidation
+        now = time.time()
+        dead = [n for n in self.segments if self._dead(n, now)]
+        self.counters["rotations"] += 1
+        number = self._nextsegment()
+        io.open(self._segpath(number), "w+b").close()
+        self.sealed.update(self.segments)
+        self.segments = [n for n in self.segments if n not in dead]
+        self.segments.append(number)
+        self._writemanifest()
+        for n in dead:
+            self._drop(n)
+            try:
+                os.remove(self._segpath(n))
+            except OSError:
+                # still open elsewhere, on platforms that do not allow
+                # removing open files
+                pass
+        return number
+
+    def _nextsegment(self):
+        # segments are numbered by the generation of the manifest they
+        # are added in, so numbers are never reused while processes may
+        # still have a removed segment open
+        self.generation += 1
+        return self.generation
+
+    def _create(self, data):
+        # start a new log, holding the given records
+        generation = self.generation
+        self._reset()
+        self.generation = generation or 0
+        self.zdict = _ZDICT
+        self.counters["restarts"] += 1
+        number = self._nextsegment()
+        io.open(self._segpath(number), "w+b").close()
+        self.segments = [number]
+        self._writemanifest()
+        for obj in sorted(data, key=lambda x: x.creation):
+            self._append(obj)
+
+    def _upgrade(self):
+        # rewrite files of other versions as a log, keeping the records of
+        # version 2 files, the last released format
+        with self._locked(Flock.LOCK_EX):
             self.cachefd.seek(0)
-            self.cachefd.truncate()
-            self.cachefd.write(self._struct.pack(self._version, size))
-            # write storage slot definitions
-            prev = None
-            for d in data:
-                if prev is None:
-                    d.position = 4 + 16 * size
-                else:
-                    d.position = prev.position + prev.size
-                d.dumpslot(self.cachefd)
-                prev = d
-            # fill in allocated slots
-            for i in range(2 ** 8):
-                self.cachefd.write(FileCacheObject._struct.pack(0, 0, 0))
-            # write stored data
-            for d in data:
-                d.dumpdata(self.cachefd)
+            header = self.cachefd.read(2)
+            version = struct.unpack("H", header)[0] if header else None
+            if version == self._version:
+                return
+            data = self._read_v2() if version == 2 else []
+            self._create(data)
 
-        self.cachefd.flush()
+    def _read_v2(self):
+        # version 2 slots hold only a timestamp, lifetime and position,
+        # with each block running up to the start of the next
+        slot = struct.Struct("dII")
+        try:
+            self.cachefd.seek(0)
+            count = struct.unpack("HH", self.cachefd.read(4))[1]
+            slots = list(
+                slot.iter_unpack(self.cachefd.read(count * slot.size))
+            )
+            self.cachefd.seek(0)
+            view = self.cachefd.read()
+        except struct.error:
+            return []
+        used = sorted((s for s in slots if s[0]), key=lambda s: s[2])
+        ends = [s[2] for s in used[1:]] + [len(view)]
+        data = []
+        for (creation, lifetime, position), stop in zip(used, ends):
+            obj = FileCacheObject.fromHeader(
+                (creation, None, lifetime, None, stop - position),
+                None,
+                position,
+            )
+            if self._retained(obj):
+                obj.load(view)
+                if obj.key is not None:
+                    data.append(obj)
+        return data
 
     def expire(self, key):
         pass
+
+    def compact(self):
+        """
+        Copy the live records of all but the segment being appended to
+        into a single new segment, and remove the old ones. Records are
+        copied without holding any lock, since full segments are no
+        longer written to. Locks are only held to take a snapshot of the
+        log, and to swap the new segment in for the old.
+        """
+        start = time.time()
+        self._init_cache()
+        parent = self.parent()
+
+        with parent._lock:
+            self._open("r+b")
+            with self._locked(Flock.LOCK_SH):
+                self._refresh()
+                sealed = self.segments[:-1]
+                live = sorted(
+                    (obj.segment, obj.position, obj.size, obj.checksum)
+                    for obj in self.index.values()
+                    if (obj.segment in sealed) and self._retained(obj)
+                )
+        report = {"reclaimed": 0, "records": 0, "seconds": 0}
+        if not sealed:
+            report["seconds"] = time.time() - start
+            return report
+
+        # copy the records, header and block, to a temporary file
+        fd, path = tempfile.mkstemp(
+            prefix=os.path.basename(self.cachefile) + ".",
+            dir=os.path.dirname(self.cachefile),
+        )
+        header = FileCacheObject._struct.size
+        before = 0
+        try:
+            with io.open(fd, "wb") as out:
+                views = {}
+                for number in sealed:
+                    with io.open(self._segpath(number), "rb") as seg:
+                        size = os.fstat(seg.fileno()).st_size
+                        before += size
+                        if size:
+                            views[number] = mmap.mmap(
+                                seg.fileno(), size, access=mmap.ACCESS_READ
+                            )
+                for number, position, size, checksum in live:
+                    first, last = position - header, position + size
+                    record = views[number][first:last]
+                    if zlib.crc32(record[header:]) == checksum:
+                        out.write(record)
+                        report["records"] += 1
+                for view in views.values():
+                    view.close()
+                out.flush()
+                os.fsync(out.fileno())
+                after = out.tell()
+        except (OSError, KeyError):
+            # segments removed by another process meanwhile
+            os.remove(path)
+            report["seconds"] = time.time() - start
+            return report
+
+        with parent._lock:
+            self._open("r+b")
+            with self._locked(Flock.LOCK_EX):
+                self._refresh()
+                if not set(sealed) <= set(self.segments[:-1]):
+                    # another process compacted or removed them first
+                    os.remove(path)
+                    report["records"] = 0
+                    report["seconds"] = time.time() - start
+                    return report
+                segments = [n for n in self.segments if n not in sealed]
+                number = self._nextsegment()
+                if report["records"]:
+                    os.replace(path, self._segpath(number))
+                    segments.insert(0, number)
+                else:
+                    os.remove(path)
+                    after = 0
+                self.segments = segments
+                self._writemanifest()
+                for number in sealed:
+                    self._drop(number)
+                    try:
+                        os.remove(self._segpath(number))
+                    except OSError:
+                        pass
+                self._refresh()
+                self.counters["compactions"] += 1
+
+        report["reclaimed"] = before - after
+        report["seconds"] = time.time() - start
+        return report
+
+    def stats(self, reset=False):
+        """
+        Return the counters kept by the engine, along with the bytes taken
+        by the log, the bytes of records still retained, and the number
+        of segments and of records indexed, as of when it was last read.
+        """
+        stats = super(FileEngine, self).stats(reset)
+        size = live = 0
+        paths = [self.cachefile] + [self._segpath(n) for n in self.segments]
+        for path in paths if self.cachefile else []:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        header = FileCacheObject._struct.size
+        for obj in self.index.values():
+            if self._retained(obj):
+                live += header + obj.size
+        stats.update(
+            bytes=size,
+            live_bytes=live,
+            segments=len(self.segments),
+            records=len(self.index),
+        )
+        return stats
+
+    def __del__(self):
+        self._stop.set()
+
+    def lock(self, key):
+        # queries are coalesced between processes by locking a byte of a
+        # separate lock file, at an offset given by a hash of the key
+        if not self.coalesce:
+            return NoLock()
+        with self.parent()._lock:
+            # opened once, as closing any descriptor of the file would
+            # release all locks held on it
+            self._init_cache()
+            if self.lockfd is None:
+                self.lockfd = io.open(self.cachefile + ".lock", "a+b")
+        return RangeLock(self.lockfd, zlib.crc32(key.encode()))
+
+
+def _compactor(engine, stop, interval):
+    # compact the cache of an engine periodically, until it is reconfigured
+    # or no longer used
+    while not stop.wait(interval):
+        obj = engine()
+        if obj is None:
+            return
+        try:
+            obj.compact()
+        except Exception:
+            pass
+        del obj
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_memory.py
+# Python Library
+# Purpose: In-memory cache engine, bounded in the number of records and
+#          the bytes they take, evicting the least recently used.
+# -----------------------
+
+from collections import OrderedDict
+import json
+
+from .cache_engine import CacheEngine, CacheObject
+
+
+class MemoryEngine(CacheEngine):
+    """
+    Engine keeping records in memory for this process only. Once either
+    budget is exceeded, the least recently used records are evicted.
+    Sizes are approximate, taken as the length of the JSON encoding of
+    each record.
+
+        max_bytes   -- (optional) budget for the size of all records
+        max_entries -- (optional) budget for the number of records
+    """
+
+    name = "memory"
+    _counters = ("evictions",)
+
+    def __init__(self, parent):
+        super(MemoryEngine, self).__init__(parent)
+        self.configure()
+
+    def configure(self, max_bytes=2**26, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.records = OrderedDict()
+        self.size = 0
+
+    def get(self, date):
+        return [obj for obj in self.records.values() if obj.creation > date]
+
+    def lookup(self, key):
+        obj = self.records.get(key)
+        return [obj] if obj is not None else []
+
+    def lookup_many(self, keys):
+        objs = (self.records.get(key) for key in set(keys))
+        return [obj for obj in objs if obj is not None]
+
+    def put(self, key, value, lifetime, validators=None, creation=None):
+        return self._insert(
+            CacheObject(key, value, lifetime, creation, validators)
+        )
+
+    def put_many(self, objs):
+        stored = []
+        for obj in objs:
+            old = self.records.get(obj.key)
+            if (old is None) or (old.creation < obj.creation):
+                copy = CacheObject(
+                    obj.key,
+                    obj.data,
+                    obj.lifetime,
+                    obj.creation,
+                    obj.validators,
+                )
+                stored.extend(self._insert(copy))
+        # later records of the batch may have evicted earlier ones
+        return [obj for obj in stored if self.records.get(obj.key) is obj]
+
+    def _insert(self, obj):
+        key = obj.key
+        obj.size = len(json.dumps([key, obj.data, obj.validators]))
+        old = self.records.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        if (obj.size > self.max_bytes) or not self.max_entries:
+            # would evict everything else, and still not fit
+            if old is not None:
+                self.parent()._evict(old)
+            return []
+        self.records[key] = obj
+        self.size += obj.size
+        while (self.size > self.max_bytes) or (
+            len(self.records) > self.max_entries
+        ):
+            self._evict()
+        return [obj]
+
+    def _evict(self):
+        key, obj = self.records.popitem(last=False)
+        self.size -= obj.size
+        self.counters["evictions"] += 1
+        self.parent()._evict(obj)
+
+    def expire(self, key):
+        obj = self.records.pop(key, None)
+        if obj is not None:
+            self.size -= obj.size
+
+    def hit(self, key):
+        if key in self.records:
+            self.records.move_to_end(key)
+
+    def stats(self, reset=False):
+        stats = super(MemoryEngine, self).stats(reset)
+        stats.update(bytes=self.size, records=len(self.records))
+        return stats
@@ -21,7 +21,7 @@ class NullEngine(CacheEngine):
     def get(self, date):
         return []
 
-    def put(self, key, value, lifetime):
+    def put(self, key, value, lifetime, validators=None, creation=None):
         return []
 
     def expire(self, key):
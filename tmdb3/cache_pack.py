@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_pack.py
+# Python Library
+# Purpose: Portable packs of cache records, used to copy a warm cache to
+#          new hosts, whatever engine either cache uses.
+# -----------------------
+
+import itertools
+import json
+import gzip
+
+from .tmdb_exceptions import *
+from .cache_engine import CacheObject
+
+####################
+# Pack Format
+# -----------
+# gzip compressed text, holding one JSON document per line, so packs may
+# be written and read as a stream
+#
+# header                {"pack": "pytmdb3", "version": 1}
+# record 0              [key, data, creation, lifetime, validators]
+# record 1
+#   ....
+# record N-1
+#
+####################
+
+_HEADER = {"pack": "pytmdb3", "version": 1}
+
+
+def write_pack(objs, fileobj):
+    """
+    Write records to a pack, given as a filename or a binary file object,
+    returning the number written.
+    """
+    count = 0
+    with gzip.open(fileobj, "wt", encoding="utf-8") as fd:
+        fd.write(json.dumps(_HEADER) + "\n")
+        for obj in objs:
+            record = [
+                obj.key,
+                obj.data,
+                obj.creation,
+                obj.lifetime,
+                obj.validators or None,
+            ]
+            fd.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def read_pack(fileobj):
+    """
+    Generate the records of a pack, given as a filename or a binary file
+    object, as they are read.
+    """
+    with gzip.open(fileobj, "rt", encoding="utf-8") as fd:
+        try:
+            header = json.loads(fd.readline())
+        except (OSError, ValueError):
+            header = None
+        if header != _HEADER:
+            raise TMDBCacheError("Not a cache pack, or of another version")
+        for line in fd:
+            key, data, creation, lifetime, validators = json.loads(line)
+            yield CacheObject(key, data, lifetime, creation, validators)
+
+
+def batches(objs, size):
+    """Split an iterable of records into lists of up to size records."""
+    objs = iter(objs)
+    while True:
+        batch = list(itertools.islice(objs, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_sqlite.py
+# Python Library
+# Purpose: Persistent cache engine storing records in an SQLite database
+#          in WAL mode, so that many processes may read and write it
+#          without blocking each other.
+# -----------------------
+
+import sqlite3
+import zlib
+import json
+import time
+import os
+import io
+
+from .tmdb_exceptions import *
+from .cache_engine import CacheEngine, CacheObject, NoLock
+from .cache_file import RangeLock, parse_filename
+
+# statements are kept as constants, so the prepared statements cached by
+# each connection are reused
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS cache ("
+    "key TEXT PRIMARY KEY, data TEXT NOT NULL, validators TEXT, "
+    "creation REAL NOT NULL, lifetime REAL NOT NULL, expires REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)",
+    "CREATE INDEX IF NOT EXISTS cache_creation ON cache (creation)",
+)
+_SELECT = (
+    "SELECT key, data, lifetime, creation, validators FROM cache "
+    "WHERE key = ? AND expires > ?"
+)
+_SELECT_NEW = (
+    "SELECT key, data, lifetime, creation, validators FROM cache "
+    "WHERE creation > ? AND expires > ?"
+)
+# keys are looked up in chunks, within the limit on bound parameters
+_SELECT_MANY = (
+    "SELECT key, data, lifetime, creation, validators FROM cache "
+    "WHERE key IN ({0}) AND expires > ?"
+)
+_CHUNK = 500
+# exported a page at a time, in key order
+_SELECT_PAGE = (
+    "SELECT key, data, lifetime, creation, validators FROM cache "
+    "WHERE key > ? AND expires > ? ORDER BY key LIMIT ?"
+)
+_INSERT = "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)"
+_INSERT_NEWER = (
+    "INSERT INTO cache VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE "
+    "SET data = excluded.data, validators = excluded.validators, "
+    "creation = excluded.creation, lifetime = excluded.lifetime, "
+    "expires = excluded.expires WHERE excluded.creation > cache.creation"
+)
+_DELETE = "DELETE FROM cache WHERE key = ? AND expires <= ?"
+_DELETE_EXPIRED = (
+    "DELETE FROM cache WHERE rowid IN "
+    "(SELECT rowid FROM cache WHERE expires <= ? LIMIT ?)"
+)
+
+
+class SQLiteEngine(CacheEngine):
+    """
+    SQLite-backed engine. The database is used in write-ahead logging
+    mode, so readers never wait for writers, and records are indexed by
+    key and by expiry. Expired records are deleted in batches, every
+    `expire_interval` seconds.
+    """
+
+    name = "sqlite"
+    _counters = ("expired", "vacuums")
+
+    def __init__(self, parent):
+        super(SQLiteEngine, self).__init__(parent)
+        self.configure(None)
+
+    def configure(
+        self,
+        filename,
+        timeout=30,
+        expire_interval=60,
+        expire_batch=1000,
+        coalesce=False,
+    ):
+        self.cachefile = filename
+        self.timeout = timeout
+        self.expire_interval = expire_interval
+        self.expire_batch = expire_batch
+        self.coalesce = coalesce
+        self.lockfd = None
+        self.conn = None
+        self.expired = time.time()
+
+    def _connect(self):
+        # connections are not shared with forked processes
+        if (self.conn is not None) and (self._pid == os.getpid()):
+            return self.conn
+        if self.cachefile is None:
+            raise TMDBCacheError("No cache filename given.")
+        filename = parse_filename(self.cachefile)
+        try:
+            # access is serialized by the cache lock, so the connection
+            # may be used from any thread
+            conn = sqlite3.connect(
+                filename,
+                timeout=self.timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+        except sqlite3.OperationalError as e:
+            if not os.path.isdir(os.path.dirname(filename) or "."):
+                raise TMDBCacheDirectoryError(filename)
+            if not os.access(filename, os.W_OK):
+                raise TMDBCacheWriteError(filename)
+            raise TMDBCacheError(str(e))
+        self.cachefile = filename
+        self.conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def _objects(self, rows):
+        return [
+            CacheObject(
+                key,
+                json.loads(data),
+                lifetime,
+                creation,
+                json.loads(validators) if validators else None,
+            )
+            for key, data, lifetime, creation, validators in rows
+        ]
+
+    def get(self, date):
+        conn = self._connect()
+        return self._objects(conn.execute(_SELECT_NEW, (date, time.time())))
+
+    def lookup(self, key):
+        conn = self._connect()
+        return self._objects(conn.execute(_SELECT, (key, time.time())))
+
+    def lookup_many(self, keys):
+        conn = self._connect()
+        keys = sorted(set(keys))
+        now = time.time()
+        objs = []
+        for start in range(0, len(keys), _CHUNK):
+            end = start + _CHUNK
+            chunk = keys[start:end]
+            statement = _SELECT_MANY.format(", ".join("?" * len(chunk)))
+            objs.extend(self._objects(conn.execute(statement, chunk + [now])))
+        return objs
+
+    def export(self, page=500):
+        # read a page of records at a time, under the cache lock, so the
+        # database is never read into memory as a whole
+        key = ""
+        while True:
+            with self.parent()._lock:
+                objs = self._objects(
+                    self._connect().execute(
+                        _SELECT_PAGE, (key, time.time(), page)
+                    )
+                )
+            for obj in objs:
+                yield obj
+            if len(objs) < page:
+                return
+            key = objs[-1].key
+
+    def _row(self, obj):
+        # kept while it may still be revalidated, or served stale
+        expires = obj.creation + obj.lifetime
+        expires += self.parent()._retention(obj.validators)
+        return (
+            obj.key,
+            json.dumps(obj.data),
+            json.dumps(obj.validators) if obj.validators else None,
+            obj.creation,
+            obj.lifetime,
+            expires,
+        )
+
+    def put(self, key, value, lifetime, validators=None, creation=None):
+        conn = self._connect()
+        obj = CacheObject(key, value, lifetime, creation, validators)
+        conn.execute(_INSERT, self._row(obj))
+        if time.time() - self.expired >= self.expire_interval:
+            self._expire()
+        return [obj]
+
+    def put_many(self, objs):
+        # written in a single transaction, only replacing older records
+        conn = self._connect()
+        objs = list(objs)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            changes = conn.total_changes
+            conn.executemany(_INSERT_NEWER, map(self._row, objs))
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if conn.total_changes - changes == len(objs):
+            return objs
+        # some were skipped, return those now stored
+        stored = []
+        for obj in objs:
+            stored.extend(
+                o for o in self.lookup(obj.key) if o.creation == obj.creation
+            )
+        return stored
+
+    def expire(self, key):
+        # only if expired, another process may have stored it again
+        self._connect().execute(_DELETE, (key, time.time()))
+
+    def _expire(self):
+        # delete expired records a batch at a time, so other processes are
+        # not held up writing by one long transaction
+        conn = self._connect()
+        now = time.time()
+        count = 0
+        while True:
+            deleted = conn.execute(
+                _DELETE_EXPIRED, (now, self.expire_batch)
+            ).rowcount
+            count += deleted
+            if deleted < self.expire_batch:
+                break
+        self.expired = now
+        self.counters["expired"] += count
+        return count
+
+    def _size(self):
+        size = 0
+        for suffix in ("", "-wal"):
+            try:
+                size += os.path.getsize(self.cachefile + suffix)
+            except OSError:
+                pass
+        return size
+
+    def compact(self):
+        """
+        Delete expired records, and return the space they took to the
+        filesystem, by checkpointing the write-ahead log and vacuuming the
+        database.
+        """
+        start = time.time()
+        with self.parent()._lock:
+            conn = self._connect()
+            before = self._size()
+            self._expire()
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            records = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            self.counters["vacuums"] += 1
+        return {
+            "reclaimed": max(before - self._size(), 0),
+            "records": records[0],
+            "seconds": time.time() - start,
+        }
+
+    def stats(self, reset=False):
+        """
+        Return the counters kept by the engine, along with the bytes taken
+        by the database and its log, and the number of records stored.
+        """
+        stats = super(SQLiteEngine, self).stats(reset)
+        records = self._connect().execute("SELECT COUNT(*) FROM cache")
+        stats.update(bytes=self._size(), records=records.fetchone()[0])
+        return stats
+
+    def lock(self, key):
+        # queries are coalesced between processes by locking a byte of a
+        # separate lock file, as with the file engine
+        if not self.coalesce:
+            return NoLock()
+        with self.parent()._lock:
+            # opened once, as closing any descriptor of the file would
+            # release all locks held on it
+            self._connect()
+            if self.lockfd is None:
+                self.lockfd = io.open(self.cachefile + ".lock", "a+b")
+        return RangeLock(self.lockfd, zlib.crc32(key.encode()))
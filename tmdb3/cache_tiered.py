@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_tiered.py
+# Python Library
+# Purpose: Two-tier cache engine, keeping recently used records in memory
+#          in front of a persistent engine shared between processes.
+# -----------------------
+
+from .tmdb_exceptions import *
+from .cache_engine import CacheEngine, CacheObject, Engines
+from .cache_memory import MemoryEngine
+
+
+class TieredEngine(CacheEngine):
+    """
+    Engine layering a bounded in-memory tier over another engine. Records
+    are written through to both tiers, and read from the memory tier
+    where present, so frequently used records never touch the backend.
+    Records missing from memory are read through from the backend, and
+    promoted into memory.
+
+        backend     -- (optional) name of the engine for the second tier
+        max_bytes   -- (optional) budget for the size of records in memory
+        max_entries -- (optional) budget for the number of records in memory
+
+    Any further arguments are used to configure the backend.
+    """
+
+    name = "tiered"
+    _counters = ("promotions",)
+
+    def __init__(self, parent):
+        super(TieredEngine, self).__init__(parent)
+        self.configure("null")
+
+    def configure(
+        self, backend="file", max_bytes=2**22, max_entries=1000, **kwargs
+    ):
+        if (backend not in Engines) or (Engines[backend] is TieredEngine):
+            raise TMDBCacheError("Invalid cache engine specified: " + backend)
+        # both tiers report to the cache itself
+        self.l1 = MemoryEngine(self.parent())
+        self.l1.configure(max_bytes, max_entries)
+        self.l2 = Engines[backend](self.parent())
+        self.l2.configure(**kwargs)
+
+    def _promote(self, objs):
+        promoted = []
+        for obj in objs:
+            copy = CacheObject(
+                obj.key, obj.data, obj.lifetime, obj.creation, obj.validators
+            )
+            # records too large for memory are still served from the
+            # backend, and are held by the cache only until they expire
+            promoted.extend(self.l1._insert(copy) or [obj])
+            self.counters["promotions"] += 1
+        return promoted
+
+    def get(self, date):
+        return self.l1.get(date)
+
+    def lookup(self, key):
+        objs = self.l1.lookup(key)
+        if objs and not objs[0].expired:
+            return objs
+        # another process may have stored a fresh copy
+        return self._promote(self.l2.lookup(key)) or objs
+
+    def lookup_many(self, keys):
+        held = dict((obj.key, obj) for obj in self.l1.lookup_many(keys))
+        objs = [obj for obj in held.values() if not obj.expired]
+        missing = [key for key in set(keys) if key not in held]
+        missing.extend(obj.key for obj in held.values() if obj.expired)
+        if missing:
+            found = self._promote(self.l2.lookup_many(missing))
+            objs.extend(found)
+            # as with lookup, expired records are kept from memory where
+            # the backend has nothing fresher
+            found = set(obj.key for obj in found)
+            objs.extend(
+                held[key]
+                for key in missing
+                if (key in held) and (key not in found)
+            )
+        return objs
+
+    def put(self, key, value, lifetime, validators=None, creation=None):
+        self.l2.put(key, value, lifetime, validators, creation)
+        return self.l1.put(key, value, lifetime, validators, creation)
+
+    def put_many(self, objs):
+        objs = list(objs)
+        self.l2.put_many(objs)
+        return self.l1.put_many(objs)
+
+    def export(self):
+        # records held only in memory are exported too, for backends such
+        # as the null engine. the memory tier is bounded, so is collected
+        # first, while the backend is streamed
+        held = dict((obj.key, obj) for obj in self.l1.export())
+        for obj in self.l2.export():
+            mine = held.get(obj.key)
+            if (mine is not None) and (mine.creation >= obj.creation):
+                continue
+            held.pop(obj.key, None)
+            yield obj
+        for obj in held.values():
+            yield obj
+
+    def expire(self, key):
+        self.l1.expire(key)
+        self.l2.expire(key)
+
+    def compact(self):
+        return self.l2.compact()
+
+    def hit(self, key):
+        self.l1.hit(key)
+
+    def stats(self, reset=False):
+        stats = super(TieredEngine, self).stats(reset)
+        stats.update(l1=self.l1.stats(reset), l2=self.l2.stats(reset))
+        return stats
+
+    def lock(self, key):
+        return self.l2.lock(key)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: connection.py
+# Python Library
+# Purpose: Pools of persistent HTTP connections, allowing the TCP (and
+#          TLS) session to a host to be reused between API requests, for
+#          both blocking and asyncio use
+# -----------------------
+
+import http.client
+import asyncio
+import base64
+import socket
+import ssl
+import urllib.error
+import urllib.parse
+import urllib.request
+import urllib.response
+import threading
+import time
+import io
+import os
+
+# failures seen when writing to, or reading from, a kept-alive connection
+# the server has already dropped. the server may still have processed the
+# request, so only idempotent requests are retried on a fresh connection.
+_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_IDEMPOTENT = ("GET", "HEAD")
+
+
+class ConnectionPool(object):
+    """
+    This class keeps a set of idle, persistent http.client connections for
+    each scheme/host/port, handing them out to requests and taking them
+    back once the response has been read. Connections are checked out
+    exclusively, so the pool may be shared freely between threads. Proxies
+    are taken from the environment (http_proxy, https_proxy, no_proxy) as
+    with urllib, once for each host until the pool is cleared. Redirects
+    are followed as urllib follows them.
+
+        maxsize -- maximum number of idle connections kept per host
+        timeout -- seconds an idle connection is kept before it is
+                   discarded rather than reused
+    """
+
+    def __init__(self, maxsize=10, timeout=60):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._proxies = {}  # proxy used for each scheme and host
+        self._pid = os.getpid()
+        self.configure(maxsize, timeout)
+        self.reset_stats()
+
+    def configure(self, maxsize=None, timeout=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if timeout is not None:
+            self.timeout = timeout
+        self.clear()
+
+    def reset_stats(self):
+        with self._lock:
+            self.created = 0
+            self.reused = 0
+            self.discarded = 0
+
+    def stats(self):
+        """Return a dictionary of connection counters."""
+        with self._lock:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+                "idle": sum(len(conns) for conns in self._idle.values()),
+            }
+
+    def clear(self):
+        """
+        Close all idle connections, and look up the proxy for each host
+        in the environment again.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            self._proxies = {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                self._close(conn)
+
+    def _checkout(self, key):
+        # hand out the most recently used idle connection, dropping any that
+        # have sat idle for longer than the timeout. returns None, counting
+        # a new connection, if there are no usable idle ones
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked, connections are shared with the parent process
+                # and must not be used by both
+                self._idle = {}
+                self._pid = os.getpid()
+            conns = self._idle.get(key, [])
+            while conns:
+                candidate, last = conns.pop()
+                if (now - last >= self.timeout) or not self._usable(candidate):
+                    stale.append(candidate)
+                    self.discarded += 1
+                else:
+                    conn = candidate
+                    self.reused += 1
+                    break
+            if conn is None:
+                self.created += 1
+        for candidate in stale:
+            self._close(candidate)
+        return conn
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append((conn, time.time()))
+                return
+            self.discarded += 1
+        self._close(conn)
+
+    def _stale(self, conn):
+        self._close(conn)
+        with self._lock:
+            self.discarded += 1
+
+    def _usable(self, conn):
+        return True
+
+    def _close(self, conn):
+        conn.close()
+
+    def _acquire(self, key):
+        conn = self._checkout(key)
+        if conn is not None:
+            return conn, True
+        scheme, host, port, proxy = key
+        if proxy is None:
+            if scheme == "https":
+                return http.client.HTTPSConnection(host, port), False
+            return http.client.HTTPConnection(host, port), False
+        phost, pport, auth = proxy
+        if scheme == "https":
+            # tunnelled through the proxy with CONNECT
+            conn = http.client.HTTPSConnection(phost, pport)
+            conn.set_tunnel(host, port, _proxy_headers(auth))
+            return conn, False
+        return http.client.HTTPConnection(phost, pport), False
+
+    def _send(self, key, method, path, body, headers):
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except _STALE_ERRORS:
+            if (not reused) or (method not in _IDEMPOTENT):
+                conn.close()
+                raise
+            # server dropped the kept-alive connection, retry on a new one
+            self._stale(conn)
+            return self._send(key, method, path, body, headers)
+        except:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+        return resp, data
+
+    def urlopen(self, method, url, body=None, headers=None, redirects=5):
+        """
+        Perform a request against the given URL, returning a file-like
+        response object in the manner of urllib.request.urlopen. Responses
+        with an HTTP error status raise urllib.error.HTTPError.
+        """
+        key, path, sent = _route(url, headers, self._proxies)
+        try:
+            resp, data = self._send(key, method, path, body, sent)
+        except (OSError, http.client.HTTPException) as e:
+            raise urllib.error.URLError(e)
+
+        location = resp.getheader("Location")
+        if (resp.status in _REDIRECTS) and location and redirects:
+            redirect = _redirect(method, resp.status, body, headers)
+            if redirect is None:
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.msg, io.BytesIO(data)
+                )
+            method, body, headers = redirect
+            url = urllib.parse.urljoin(url, location)
+            return self.urlopen(method, url, body, headers, redirects - 1)
+        return _response(url, resp.status, resp.reason, resp.msg, data)
+
+
+class _AsyncConnection(object):
+    """Stream pair of an open connection, and the loop it belongs to."""
+
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+
+
+class AsyncConnectionPool(ConnectionPool):
+    """
+    Asyncio counterpart of ConnectionPool, speaking HTTP/1.1 over asyncio
+    streams so requests can be multiplexed on a single event loop without
+    blocking it. Connections are only reused on the loop they were opened
+    on.
+    """
+
+    def _usable(self, conn):
+        return (conn.loop is asyncio.get_running_loop()) and (
+            not conn.writer.is_closing()
+        )
+
+    def _close(self, conn):
+        try:
+            conn.writer.close()
+        except RuntimeError:
+            # owning event loop has already been closed
+            pass
+
+    async def _acquire(self, key):
+        conn = self._checkout(key)
+        if conn is not None:
+            return conn, True
+        scheme, host, port, proxy = key
+        if proxy is None:
+            if scheme == "https":
+                reader, writer = await asyncio.open_connection(
+                    host, port or 443, ssl=ssl.create_default_context()
+                )
+            else:
+                reader, writer = await asyncio.open_connection(
+                    host, port or 80
+                )
+        elif scheme == "https":
+            # the tunnel is set up on a blocking socket, which TLS is then
+            # started over on the loop
+            sock = await asyncio.get_running_loop().run_in_executor(
+                None, _tunnel, proxy, host, port or 443
+            )
+            reader, writer = await asyncio.open_connection(
+                sock=sock,
+                ssl=ssl.create_default_context(),
+                server_hostname=host,
+            )
+        else:
+            reader, writer = await asyncio.open_connection(*proxy[:2])
+        return (
+            _AsyncConnection(reader, writer, asyncio.get_running_loop()),
+            False,
+        )
+
+    async def _send(self, key, method, path, body, headers):
+        conn, reused = await self._acquire(key)
+        try:
+            status, reason, msg, data, will_close = await self._exchange(
+                conn, key, method, path, body, headers
+            )
+        except _STALE_ERRORS + (asyncio.IncompleteReadError,):
+            if (not reused) or (method not in _IDEMPOTENT):
+                self._close(conn)
+                raise
+            # server dropped the kept-alive connection, retry on a new one
+            self._stale(conn)
+            return await self._send(key, method, path, body, headers)
+        except:
+            self._close(conn)
+            raise
+
+        if will_close:
+            self._close(conn)
+        else:
+            self._checkin(key, conn)
+        return status, reason, msg, data
+
+    async def _exchange(self, conn, key, method, path, body, headers):
+        scheme, host, port, proxy = key
+        lines = [f"{method} {path} HTTP/1.1"]
+        headers = dict(headers)
+        headers.setdefault("Host", host if port is None else f"{host}:{port}")
+        headers.setdefault("Accept-Encoding", "identity")
+        if body is not None:
+            headers["Content-Length"] = str(len(body))
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        conn.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if body is not None:
+            conn.writer.write(body)
+        await conn.writer.drain()
+
+        statusline = await conn.reader.readline()
+        if not statusline:
+            raise http.client.RemoteDisconnected(
+                "Remote end closed connection without response"
+            )
+        try:
+            version, status, reason = (
+                statusline.decode("latin-1").rstrip("\r\n").split(" ", 2)
+                + [""]
+            )[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(statusline)
+
+        raw = b""
+        while True:
+            line = await conn.reader.readline()
+            raw += line
+            if line in (b"\r\n", b"\n", b""):
+                break
+        msg = http.client.parse_headers(io.BytesIO(raw))
+
+        will_close = (version == "HTTP/1.0") or (
+            (msg.get("Connection") or "").lower() == "close"
+        )
+        if (method == "HEAD") or (status in (204, 304)) or (status < 200):
+            data = b""
+        elif (msg.get("Transfer-Encoding") or "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int((await conn.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # discard any trailers
+                    while (await conn.reader.readline()) not in (
+                        b"\r\n",
+                        b"\n",
+                        b"",
+                    ):
+                        pass
+                    break
+                data += await conn.reader.readexactly(size)
+                await conn.reader.readline()
+        elif msg.get("Content-Length") is not None:
+            data = await conn.reader.readexactly(int(msg["Content-Length"]))
+        else:
+            data = await conn.reader.read()
+            will_close = True
+        return status, reason, msg, data, will_close
+
+    async def urlopen(self, method, url, body=None, headers=None, redirects=5):
+        """
+        Perform a request against the given URL, returning a file-like
+        response object once it has been read in full. Responses with an
+        HTTP error status raise urllib.error.HTTPError.
+        """
+        key, path, sent = _route(url, headers, self._proxies)
+        try:
+            status, reason, msg, data = await self._send(
+                key, method, path, body, sent
+            )
+        except (OSError, http.client.HTTPException) as e:
+            raise urllib.error.URLError(e)
+
+        location = msg.get("Location")
+        if (status in _REDIRECTS) and location and redirects:
+            redirect = _redirect(method, status, body, headers)
+            if redirect is None:
+                raise urllib.error.HTTPError(
+                    url, status, reason, msg, io.BytesIO(data)
+                )
+            method, body, headers = redirect
+            url = urllib.parse.urljoin(url, location)
+            return await self.urlopen(
+                method, url, body, headers, redirects - 1
+            )
+        return _response(url, status, reason, msg, data)
+
+
+def _route(url, headers=None, proxies=None):
+    # split a URL into the pool key, the path to request and the headers
+    # to send. plain http requests through a proxy are sent to it with the
+    # absolute URL, while https requests are tunnelled. the proxy for each
+    # scheme and host is kept in proxies, once worked out
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path = f"{path}?{parts.query}"
+    headers = dict(headers or {})
+    if proxies is None:
+        proxies = {}
+    target = (parts.scheme, parts.hostname)
+    if target not in proxies:
+        proxies[target] = _proxy(*target)
+    proxy = proxies[target]
+    if (proxy is not None) and (parts.scheme == "http"):
+        path = urllib.parse.urlunsplit(parts[:3] + (parts.query, ""))
+        headers.update(_proxy_headers(proxy[2]) or {})
+    return (parts.scheme, parts.hostname, parts.port, proxy), path, headers
+
+
+def _redirect(method, status, body, headers):
+    # the method, body and headers a redirect is followed with, as urllib
+    # follows them, or None if it is not followed. POST requests are sent
+    # on as GET, without their body, and redirects of other methods are
+    # only followed for GET and HEAD
+    if method in _IDEMPOTENT:
+        return method, body, headers
+    if (method == "POST") and (status in (301, 302, 303)):
+        headers = dict(
+            (k, v)
+            for k, v in (headers or {}).items()
+            if k.lower() not in ("content-length", "content-type")
+        )
+        return "GET", None, headers
+    return None
+
+
+def _proxy(scheme, host):
+    # the proxy configured in the environment for the scheme and host, as
+    # (host, port, credentials), or None to connect directly
+    url = urllib.request.getproxies().get(scheme)
+    if (not url) or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in url:
+        url = "http://" + url
+    parts = urllib.parse.urlsplit(url)
+    auth = None
+    if parts.username is not None:
+        auth = "{0}:{1}".format(
+            urllib.parse.unquote(parts.username),
+            urllib.parse.unquote(parts.password or ""),
+        )
+    return parts.hostname, parts.port or 80, auth
+
+
+def _proxy_headers(auth):
+    if auth is None:
+        return None
+    token = base64.b64encode(auth.encode()).decode("ascii")
+    return {"Proxy-Authorization": "Basic " + token}
+
+
+def _tunnel(proxy, host, port):
+    # open a socket to the host through the proxy with CONNECT, reading
+    # the reply a byte at a time so nothing of the tunnel is consumed
+    phost, pport, auth = proxy
+    sock = socket.create_connection((phost, pport))
+    try:
+        lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+        lines.extend(
+            f"{k}: {v}" for k, v in (_proxy_headers(auth) or {}).items()
+        )
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        reply = b""
+        while not reply.endswith(b"\r\n\r\n"):
+            byte = sock.recv(1)
+            if not byte:
+                raise http.client.RemoteDisconnected(
+                    "Proxy closed connection without response"
+                )
+            reply += byte
+        statusline = reply.split(b"\r\n", 1)[0].decode("latin-1")
+        if statusline.split(" ", 2)[1:2] != ["200"]:
+            raise OSError(f"Tunnel connection failed: {statusline}")
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def _response(url, status, reason, msg, data):
+    # wrap a read response the way urllib.request.urlopen would
+    if status >= 400:
+        raise urllib.error.HTTPError(
+            url, status, reason, msg, io.BytesIO(data)
+        )
+    return urllib.response.addinfourl(io.BytesIO(data), msg, url, status)
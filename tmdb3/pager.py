@@ -6,8 +6,11 @@
 # Author: Raymond Wagner
 # -----------------------
 from abc import ABC
+import asyncio
 from collections import Sequence, Iterator
 
+from .request import read_many
+
 
 class PagedIterator(Iterator):
     def __init__(self, parent):
@@ -66,15 +69,25 @@ class PagedList(Sequence):
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return [self[x] for x in range(*index.indices(len(self)))]
+            indices = range(*index.indices(len(self)))
+            # the missing pages of a slice are populated together
+            pages = set(
+                i // self._pagesize + 1 for i in indices if self._unpaged(i)
+            )
+            if pages:
+                self._populatepages(sorted(pages))
+            return [self[x] for x in indices]
         if index >= len(self):
             raise IndexError("list index outside range")
-        if (index >= len(self._data)) or isinstance(
-            self._data[index], UnpagedData
-        ):
-            self._populatepage(index / self._pagesize + 1)
+        if self._unpaged(index):
+            self._populatepage(index // self._pagesize + 1)
         return self._data[index]
 
+    def _unpaged(self, index):
+        return (index >= len(self._data)) or isinstance(
+            self._data[index], UnpagedData
+        )
+
     def __setitem__(self, index, value):
         raise NotImplementedError
 
@@ -85,13 +98,20 @@ class PagedList(Sequence):
         raise NotImplementedError
 
     def _populatepage(self, page):
+        self._storepage(page, self._getpage(page))
+
+    def _populatepages(self, pages):
+        for page in pages:
+            self._populatepage(page)
+
+    def _storepage(self, page, items):
         pagestart = (page - 1) * self._pagesize
         if len(self._data) < pagestart:
             self._data.extend(UnpagedData() * (pagestart - len(self._data)))
         if len(self._data) == pagestart:
-            self._data.extend(self._getpage(page))
+            self._data.extend(items)
         else:
-            for data in self._getpage(page):
+            for data in items:
                 self._data[pagestart] = data
                 pagestart += 1
 
@@ -111,14 +131,59 @@ class PagedRequest(ABC, PagedList):
         self._request = request
         if handler:
             self._handler = handler
-        super(PagedRequest, self).__init__(self._getpage(1), 20)
+        super(PagedRequest, self).__init__([], 20)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop running, so query the first page right away
+            self._populatepage(1)
+        # otherwise the first page is left to be queried once it is
+        # needed, either by blocking access or by async iteration
+
+    def __len__(self):
+        if not hasattr(self, "_len"):
+            self._populatepage(1)
+        return self._len
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        # async iteration, awaiting each page as it is needed
+        index = 0
+        while True:
+            if not hasattr(self, "_len") or (
+                (index < self._len)
+                and (
+                    (index >= len(self._data))
+                    or isinstance(self._data[index], UnpagedData)
+                )
+            ):
+                page = index // self._pagesize + 1
+                self._storepage(page, await self._getpage_async(page))
+            if (index >= self._len) or (index >= len(self._data)):
+                return
+            yield self._data[index]
+            index += 1
 
     def _getpage(self, page):
         req = self._request.new(page=page)
-        res = req.readJSON()
+        return self._handle(req.readJSON())
+
+    def _populatepages(self, pages):
+        # cached pages are read together, and pages queried are written to
+        # the cache together
+        reqs = [self._request.new(page=page) for page in pages]
+        for page, res in zip(pages, read_many(reqs)):
+            self._storepage(page, self._handle(res))
+
+    async def _getpage_async(self, page):
+        req = self._request.new(page=page)
+        return self._handle(await req.readJSONAsync())
+
+    def _handle(self, res):
         self._len = res["total_results"]
-        for item in res["results"]:
-            if item is None:
-                yield None
-            else:
-                yield self._handler(item)
+        return [
+            None if item is None else self._handler(item)
+            for item in res["results"]
+        ]
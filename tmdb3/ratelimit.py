@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: ratelimit.py
+# Python Library
+# Purpose: Token bucket rate limiter for requests against the TMDb API,
+#          optionally sharing its state between processes through a
+#          flocked file, along with the retry policy and adaptive
+#          concurrency limit driven by the server's responses
+# -----------------------
+
+from email.utils import parsedate_to_datetime
+import collections
+import contextlib
+import threading
+import asyncio
+import random
+import struct
+import time
+import os
+import io
+
+from .tmdb_exceptions import *
+from .cache_file import Flock, parse_filename
+
+DEBUG = False
+
+
+class RateLimiter(object):
+    """
+    This class implements a token bucket, refilled at a steady rate up to
+    a maximum burst size. Each request takes a token, waiting for one to
+    become available if the bucket is empty. Tokens are reserved in the
+    order requests arrive, so waiting requests are served fairly.
+
+    While adaptive, the rate and burst are only used until the server
+    announces its own limit with the X-RateLimit-Limit and
+    X-RateLimit-Reset headers, and the bucket is then sized to match it.
+    Responses without those headers leave the bucket as it is.
+
+        rate     -- tokens added per second. None or zero disables rate
+                    limiting
+        burst    -- maximum number of tokens held by the bucket
+        filename -- (optional) file used to share the bucket between
+                    processes. relative paths are put in the temporary
+                    directory, as with the file cache engine
+        adaptive -- (optional) follow the limit announced by the server
+    """
+
+    _struct = struct.Struct("dd")  # tokens, and time of last update
+
+    def __init__(self, rate=3.0, burst=30, filename=None, adaptive=True):
+        self._lock = threading.Lock()
+        self._fd = None
+        self._paused = 0
+        self._window = 0
+        self._counters = self._zero()
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.configure(filename=filename)
+
+    def configure(self, rate=None, burst=None, filename=None, adaptive=None):
+        """
+        Change the rate and burst size, if given, and the file used to
+        share the bucket. Without a filename, the bucket is kept in
+        memory for this process only. Giving a rate stops the limiter
+        adapting to the server, unless asked to.
+        """
+        with self._lock:
+            if rate is not None:
+                self.rate = rate
+                self.adaptive = False
+            if burst is not None:
+                self.burst = burst
+            if adaptive is not None:
+                self.adaptive = adaptive
+            if self._fd is not None:
+                self._fd.close()
+            self._fd = None
+            self.filename = None
+            if filename is not None:
+                self.filename = parse_filename(filename)
+            self._state = (self.burst, time.time())
+
+    @staticmethod
+    def _zero():
+        return {"sleeps": 0, "seconds": 0, "pauses": 0}
+
+    def stats(self, reset=False):
+        """
+        Return a dictionary of the number of times requests have waited
+        for the rate limit, the seconds spent waiting, and the number of
+        pauses asked for by the server, optionally resetting them.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            if reset:
+                self._counters = self._zero()
+        return stats
+
+    def _wait(self, wait):
+        with self._lock:
+            self._counters["sleeps"] += 1
+            self._counters["seconds"] += wait
+        if DEBUG:
+            print("rate limiting - waiting {0} seconds".format(wait))
+
+    def _reserve(self, state):
+        # refill the bucket for the time passed, and take a token from it.
+        # tokens may go negative, reserving them for waiting requests
+        tokens, last = state
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - last) * self.rate) - 1
+        wait = 0
+        if tokens < 0:
+            wait = -tokens / self.rate
+        return (tokens, now), wait
+
+    def _open(self):
+        # a flock is shared by all processes using the same open file, so
+        # each forked process must open the file itself
+        if (self._fd is None) or (self._pid != os.getpid()):
+            with io.open(self.filename, "ab") as fd:
+                if fd.tell() == 0:
+                    # new file, start with a full bucket
+                    fd.write(self._struct.pack(self.burst, time.time()))
+            self._fd = io.open(self.filename, "r+b")
+            self._pid = os.getpid()
+        return self._fd
+
+    def pause(self, seconds):
+        """Hold back all requests for the given number of seconds."""
+        with self._lock:
+            self._paused = max(self._paused, time.time() + seconds)
+            self._counters["pauses"] += 1
+
+    def observe(self, status, headers):
+        """
+        Pause requests when the server responds that the rate limit has
+        been exceeded, for as long as it asks, or when it reports the
+        remaining quota is used up, until the quota is reset. While
+        adaptive, the bucket follows the limit the server announces.
+        """
+        if self.adaptive and (status < 400):
+            self._adapt(headers)
+        if status == 429:
+            after = retry_after(headers)
+            if after is not None:
+                self.pause(after)
+        elif _header(headers, "X-RateLimit-Remaining") == 0:
+            reset = _header(headers, "X-RateLimit-Reset")
+            if reset is not None:
+                self.pause(reset - time.time())
+
+    def _adapt(self, headers):
+        # size the bucket to the quota, refilled over the window it is
+        # given for. the window is the longest time to the reset seen,
+        # which is close to the whole window from its first request
+        quota = _header(headers, "X-RateLimit-Limit")
+        reset = _header(headers, "X-RateLimit-Reset")
+        with self._lock:
+            if (not quota) or (reset is None):
+                # no limit announced, the bucket is kept as configured
+                return
+            window = reset - time.time()
+            if 0 < window <= 3600:
+                self._window = max(self._window, window)
+                self.rate = quota / self._window
+                self.burst = quota
+
+    def reserve(self):
+        """
+        Take a token, returning the number of seconds to wait before it
+        may be used.
+        """
+        paused = max(self._paused - time.time(), 0)
+        if not self.rate:
+            return paused
+        with self._lock:
+            if self.filename is None:
+                self._state, wait = self._reserve(self._state)
+                return max(wait, paused)
+
+            fd = self._open()
+            with Flock(fd, Flock.LOCK_EX):
+                fd.seek(0)
+                data = fd.read(self._struct.size)
+                if len(data) == self._struct.size:
+                    state = self._struct.unpack(data)
+                else:
+                    # damaged file, start again with a full bucket
+                    state = (self.burst, time.time())
+                state, wait = self._reserve(state)
+                fd.seek(0)
+                fd.write(self._struct.pack(*state))
+                fd.flush()
+            return max(wait, paused)
+
+    def acquire(self):
+        """Take a token, blocking until it may be used."""
+        wait = self.reserve()
+        if wait > 0:
+            self._wait(wait)
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Take a token, without blocking the event loop while waiting."""
+        wait = self.reserve()
+        if wait > 0:
+            self._wait(wait)
+            await asyncio.sleep(wait)
+
+
+class ConcurrencyLimiter(object):
+    """
+    This class implements an adaptive limit on the number of requests in
+    flight at once. The limit grows by about one for each round of
+    successful requests, and is halved whenever the server signals it is
+    overloaded, with a 429 or 5xx response, or by reporting its remaining
+    quota is nearly used up. Batch workloads thereby settle at the
+    highest concurrency the server sustains.
+
+        limit   -- initial limit
+        minimum -- lowest the limit may be reduced to
+        maximum -- highest the limit may grow to
+    """
+
+    def __init__(self, limit=8, minimum=1, maximum=64):
+        self._cond = threading.Condition()
+        self._waiters = collections.deque()
+        self._decreased = 0
+        self.inflight = 0
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def configure(self, limit=None, minimum=None, maximum=None):
+        with self._cond:
+            if limit is not None:
+                self.limit = limit
+            if minimum is not None:
+                self.minimum = minimum
+            if maximum is not None:
+                self.maximum = maximum
+            self.limit = min(max(self.limit, self.minimum), self.maximum)
+            self._wake()
+
+    def _take(self):
+        if self.inflight < int(self.limit):
+            self.inflight += 1
+            return True
+        return False
+
+    def _wake(self):
+        # hand free slots to waiting coroutines, in the order they came,
+        # then let blocked threads compete for any left
+        while self._waiters and (self.inflight < int(self.limit)):
+            loop, future = self._waiters.popleft()
+            self.inflight += 1
+            try:
+                loop.call_soon_threadsafe(_grant, future)
+            except RuntimeError:
+                # event loop closed, the slot is free again
+                self.inflight -= 1
+        self._cond.notify_all()
+
+    def acquire(self):
+        """
+        Wait for the number of requests in flight to drop below limit,
+        returning whether a slot was taken. Requests made from the thread
+        of a running event loop are not held back, since waiting would
+        block the coroutines holding the slots from releasing them.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            return False
+        with self._cond:
+            while self._waiters or not self._take():
+                self._cond.wait()
+        return True
+
+    async def acquire_async(self):
+        """
+        Awaitable acquire, waiting for a slot to be handed over without
+        blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if (not self._waiters) and self._take():
+                return True
+            self._waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._cond:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
+                else:
+                    # cancelled after being handed a slot
+                    self._release()
+            raise
+        return True
+
+    def release(self):
+        with self._cond:
+            self._release()
+
+    def _release(self):
+        self.inflight -= 1
+        self._wake()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager holding a slot while a request is in flight."""
+        taken = self.acquire()
+        try:
+            yield
+        finally:
+            if taken:
+                self.release()
+
+    def observe(self, status, headers):
+        """Adjust the limit from the status and headers of a response."""
+        remaining = _header(headers, "X-RateLimit-Remaining")
+        quota = _header(headers, "X-RateLimit-Limit")
+        with self._cond:
+            if (status == 429) or (status >= 500):
+                self._decrease(0.5)
+            elif (
+                (remaining is not None) and quota and (remaining < quota / 10)
+            ):
+                self._decrease(0.75)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._wake()
+
+    def _decrease(self, factor):
+        # responses to requests sent before the limit was last decreased
+        # carry no new information, so decrease at most once per second
+        now = time.time()
+        if now - self._decreased >= 1:
+            self.limit = max(self.minimum, self.limit * factor)
+            self._decreased = now
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and after how long, a failed request is retried.
+    Rate limited (429) and server error (5xx) responses, and the TMDb
+    service being offline, are retried with exponential backoff and full
+    jitter, or after the delay requested by the server's Retry-After
+    header.
+
+        retries -- number of times a request is retried
+        backoff -- base delay, doubled with each attempt
+        maximum -- maximum delay before an attempt
+    """
+
+    def __init__(self, retries=3, backoff=0.5, maximum=30):
+        self.configure(retries, backoff, maximum)
+
+    def configure(self, retries=None, backoff=None, maximum=None):
+        if retries is not None:
+            self.retries = retries
+        if backoff is not None:
+            self.backoff = backoff
+        if maximum is not None:
+            self.maximum = maximum
+
+    def delay(self, attempt, error):
+        """
+        Return the number of seconds to wait before retrying a request
+        that failed with the given error, or None if it should not be
+        retried.
+        """
+        if attempt >= self.retries:
+            return None
+        after = None
+        if isinstance(error, TMDBHTTPError):
+            if (error.httperrno != 429) and (error.httperrno < 500):
+                return None
+            after = retry_after(error.headers)
+        elif not isinstance(error, TMDBOffline):
+            return None
+        delay = random.uniform(0, min(self.maximum, self.backoff * 2**attempt))
+        if after is not None:
+            delay = min(self.maximum, after) + delay
+        if DEBUG:
+            print("retrying - waiting {0} seconds".format(delay))
+        return delay
+
+
+def _grant(future):
+    # called on the loop of a waiting coroutine, once handed a slot. if it
+    # was cancelled meanwhile, the slot is released by the cancelled waiter
+    if not future.done():
+        future.set_result(None)
+
+
+def _header(headers, name):
+    # return the numeric value of a header, or None if missing or invalid
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def retry_after(headers):
+    """
+    Return the number of seconds given by a Retry-After header, as either
+    a number of seconds or an HTTP date, or None if there is none.
+    """
+    if headers is None:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -11,14 +11,36 @@
 from .tmdb_exceptions import *
 from .locales import get_locale
 from .cache import Cache
+from .cache_engine import request_key
+from .connection import ConnectionPool, AsyncConnectionPool
+from .ratelimit import RateLimiter, ConcurrencyLimiter, RetryPolicy
 
 import urllib.request
 import urllib.error
 import urllib.parse
+import fnmatch
+import asyncio
 import json
+import time
 
 DEBUG = False
 cache = Cache(filename="pytmdb3.cache")
+pool = ConnectionPool()
+apool = AsyncConnectionPool()
+ratelimiter = RateLimiter()
+concurrency = ConcurrencyLimiter()
+retry = RetryPolicy()
+stale_grace = {}  # seconds expired records may be served, by endpoint
+
+# seconds responses are cached for, by endpoint. endpoints are patterns
+# matched against the API path, the most specific pattern applying
+lifetimes = {
+    "*": 60 * 60,
+    "configuration": 60 * 60 * 24,
+    "genre/*": 60 * 60 * 24,
+    "latest/movie": 60 * 10,
+}
+negative_lifetime = 300  # seconds invalid ids are cached for
 
 # DEBUG = True
 # cache = Cache(engine='null')
@@ -39,10 +61,146 @@ def set_key(key):
 
 
 def set_cache(engine=None, *args, **kwargs):
-    """Specify caching engine and properties."""
+    """
+    Specify caching engine and properties. A dictionary of lifetimes may
+    be given, updating the seconds responses are cached for by endpoint,
+    as patterns such as 'configuration' or 'movie/*'.
+    """
+    lifetimes.update(kwargs.pop("lifetimes", {}))
     cache.configure(engine, *args, **kwargs)
 
 
+def compact_cache():
+    """
+    Reclaim space in the cache taken by expired and replaced records.
+    Returns a dictionary of the bytes reclaimed, records kept, and
+    seconds spent.
+    """
+    return cache.compact()
+
+
+def export_cache(filename):
+    """
+    Write the live records of the cache to a compressed pack file, to be
+    loaded into the cache of another host with import_cache. Returns the
+    number of records written.
+    """
+    return cache.export(filename)
+
+
+def import_cache(filename):
+    """
+    Load the records of a pack file written by export_cache into the
+    cache, keeping the time they were created and their lifetime. Returns
+    the number of records stored.
+    """
+    return cache.load(filename)
+
+
+def read_many(requests):
+    """
+    Return the parsed responses of many requests, in order. Cached
+    responses are read from the cache engine together, and those queried
+    are written to it together once all have been read.
+    """
+    requests = list(requests)
+    cache.preload(req.cache_key() for req in requests if req.lifetime != 0)
+    with cache.deferred():
+        return [req.readJSON() for req in requests]
+
+
+def get_stats(reset=False):
+    """
+    Return a dictionary of the statistics kept by the cache and its
+    engine, and by the rate limiter, optionally resetting the counters.
+    """
+    return {"cache": cache.stats(reset), "ratelimit": ratelimiter.stats(reset)}
+
+
+def set_pool(maxsize=None, timeout=None):
+    """
+    Specify the number of idle connections kept open per host, and the
+    number of seconds an idle connection may be kept before it is closed.
+    """
+    pool.configure(maxsize, timeout)
+    apool.configure(maxsize, timeout)
+
+
+def set_ratelimit(rate=None, burst=None, filename=None, adaptive=None):
+    """
+    Specify the sustained number of requests per second, and the number
+    of requests that may be made in a burst above that rate. Giving a
+    filename shares the limit between all processes using that file.
+    A rate of zero disables rate limiting. Until a rate is given, the
+    limit follows the one announced by the server, as it does again if
+    adaptive is set.
+    """
+    ratelimiter.configure(rate, burst, filename, adaptive)
+
+
+def set_concurrency(limit=None, minimum=None, maximum=None):
+    """
+    Specify the initial, minimum and maximum number of requests allowed
+    in flight at once. The limit adapts between the minimum and maximum
+    to the load reported by the server.
+    """
+    concurrency.configure(limit, minimum, maximum)
+
+
+def set_retry(retries=None, backoff=None, maximum=None):
+    """
+    Specify how many times requests that were rate limited, or failed
+    with a server error, are retried, along with the base and maximum
+    delay in seconds between attempts.
+    """
+    retry.configure(retries, backoff, maximum)
+
+
+def set_negative(lifetime):
+    """
+    Specify the number of seconds requests for invalid ids, and for
+    resources that do not exist, are cached for, raising the same error
+    again until they expire. A lifetime of zero disables caching them.
+    """
+    global negative_lifetime
+    negative_lifetime = lifetime
+
+
+def set_stale(grace, *endpoints):
+    """
+    Serve expired records of the given endpoints for up to grace seconds
+    after they expire, while they are refreshed in the background, rather
+    than waiting on the refresh. Endpoints are patterns matched against
+    the API path, such as 'configuration' or 'movie/*', the most specific
+    pattern applying. Without endpoints, the grace applies to all. A grace
+    of zero turns stale records off.
+    """
+    for endpoint in endpoints or ("*",):
+        stale_grace[endpoint] = grace
+    cache.retain(max(stale_grace.values()))
+
+
+def _endpoint(table, path, default=None):
+    # look up the setting for an API path in a table keyed by pattern,
+    # taking the longest, most specific, matching pattern
+    matches = [p for p in table if fnmatch.fnmatchcase(path, p)]
+    if not matches:
+        return default
+    return table[max(matches, key=len)]
+
+
+# validators stored with a response, as (name, response header, request
+# header), the last being used to revalidate the response once expired
+_VALIDATORS = (
+    ("etag", "ETag", "If-None-Match"),
+    ("modified", "Last-Modified", "If-Modified-Since"),
+)
+
+# status codes of errors that are cached, being invalid ids and resources
+# not found, which will not succeed if queried again
+_NEGATIVE = frozenset([6, 34])
+
+
 class Request(urllib.request.Request):
     _api_key = None
     _base_url = "http://api.themoviedb.org/3/"
@@ -86,7 +244,8 @@ class Request(urllib.request.Request):
 
         urllib.request.Request.__init__(self, url)
         self.add_header("Accept", "application/json")
-        self.lifetime = 3600  # 1hr
+        self.lifetime = _endpoint(lifetimes, self._url, 3600)
+        self.grace = _endpoint(stale_grace, self._url, 0)
 
     def new(self, **kwargs):
         """
@@ -105,43 +264,200 @@ class Request(urllib.request.Request):
 
     def add_data(self, data):
         """Provide data to be sent with POST."""
-        urllib.request.Request.data = self, urllib.parse.urlencode(data)
+        self.data = urllib.parse.urlencode(data).encode()
+        self.add_header("Content-Type", "application/x-www-form-urlencoded")
 
     def open(self):
         """Open a file object to the specified URL."""
+        ratelimiter.acquire()
+        with concurrency.slot():
+            try:
+                self._debug()
+                res = pool.urlopen(
+                    self.get_method(),
+                    self.get_full_url(),
+                    self.data,
+                    dict(self.header_items()),
+                )
+            except urllib.error.HTTPError as e:
+                self._observe(e.code, e.headers)
+                raise TMDBHTTPError(e)
+        self._observe(res.status, res.headers)
+        return res
+
+    async def openAsync(self):
+        """
+        Open a file object to the specified URL, without blocking the
+        event loop.
+        """
+        await ratelimiter.acquire_async()
+        await concurrency.acquire_async()
         try:
-            if DEBUG:
-                print("loading " + self.get_full_url())
-                if self.data:
-                    print("  " + self.data)
-            return urllib.request.urlopen(self)
+            self._debug()
+            res = await apool.urlopen(
+                self.get_method(),
+                self.get_full_url(),
+                self.data,
+                dict(self.header_items()),
+            )
         except urllib.error.HTTPError as e:
+            self._observe(e.code, e.headers)
             raise TMDBHTTPError(e)
+        finally:
+            concurrency.release()
+        self._observe(res.status, res.headers)
+        return res
+
+    def _observe(self, status, headers):
+        # feed the response back to the limiters
+        ratelimiter.observe(status, headers)
+        concurrency.observe(status, headers)
 
     def read(self):
         """Return result from specified URL as a string."""
         return self.open().read()
 
-    @cache.cached(urllib.request.Request.get_full_url)
+    def cache_key(self):
+        """
+        Return the key results are cached under, independent of parameter
+        order and of the API key.
+        """
+        return request_key(self.get_full_url())
+
     def readJSON(self):
         """Parse result from specified URL as JSON data."""
-        url = self.get_full_url()
+        return self._checked(self._readCached())
+
+    async def readJSONAsync(self):
+        """Awaitable readJSON, sharing the same cache."""
+        return self._checked(await self._readCachedAsync())
+
+    @cache.cached(cache_key)
+    def _readCached(self):
+        attempt = 0
+        while True:
+            try:
+                return self._readJSON()
+            except TMDBRequestInvalid as e:
+                return self._negative(e)
+            except (TMDBHTTPError, TMDBOffline) as e:
+                wait = retry.delay(attempt, e)
+                if wait is None:
+                    raise
+            attempt += 1
+            time.sleep(wait)
+
+    @cache.cached_async(cache_key)
+    async def _readCachedAsync(self):
+        attempt = 0
+        while True:
+            try:
+                return await self._readJSONAsync()
+            except TMDBRequestInvalid as e:
+                return self._negative(e)
+            except (TMDBHTTPError, TMDBOffline) as e:
+                wait = retry.delay(attempt, e)
+                if wait is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(wait)
+
+    def _negative(self, error):
+        # invalid ids are cached, for a lifetime of their own, as the
+        # status TMDb answered with, which is raised again when read
+        status = getattr(error, "tmdberrno", None)
+        if (not negative_lifetime) or (status not in _NEGATIVE):
+            raise error
+        self.validators = {}
+        self.response_lifetime = negative_lifetime
+        return {"status_code": status, "status_message": str(error)}
+
+    def _checked(self, data):
+        if isinstance(data, dict) and (data.get("status_code") in _NEGATIVE):
+            handle_status(data, self.get_full_url())
+        return data
+
+    def _readJSON(self):
+        stale = self._conditional()
         try:
             # catch HTTP error from open()
-            data = json.load(self.open())
+            res = self.open()
         except TMDBHTTPError as e:
-            try:
-                # try to load whatever was returned
-                data = json.loads(e.response)
-            except:
-                # cannot parse json, just raise existing error
-                raise e
-            else:
-                # response parsed, try to raise error from TMDB
-                handle_status(data, url)
-            # no error from TMDB, just raise existing error
+            self._raise_http_error(e)
+        finally:
+            self._unconditional()
+        return self._revalidated(res, stale)
+
+    async def _readJSONAsync(self):
+        stale = self._conditional()
+        try:
+            # catch HTTP error from openAsync()
+            res = await self.openAsync()
+        except TMDBHTTPError as e:
+            self._raise_http_error(e)
+        finally:
+            self._unconditional()
+        return self._revalidated(res, stale)
+
+    def _conditional(self):
+        # make the request conditional on the validators of an expired
+        # record, so an unchanged resource need not be sent again
+        self.validators = {}
+        self.response_lifetime = None
+        if not self.lifetime:
+            return None
+        stale = cache.stale(self.cache_key())
+        if stale is None:
+            return None
+        for name, _, header in _VALIDATORS:
+            if name in stale.validators:
+                self.add_header(header, stale.validators[name])
+        return stale
+
+    def _unconditional(self):
+        for _, _, header in _VALIDATORS:
+            self.remove_header(header.capitalize())
+
+    def _revalidated(self, res, stale):
+        # pull the validators from the response, and the data from it or,
+        # if unchanged, from the expired record so its lifetime is renewed
+        validators = dict(stale.validators) if stale is not None else {}
+        for name, header, _ in _VALIDATORS:
+            if res.headers.get(header) is not None:
+                validators[name] = res.headers[header]
+        if (res.status == 304) and (stale is not None):
+            if DEBUG:
+                print("  not modified")
+            self.validators = validators
+            return stale.data
+        data = self._process(json.load(res))
+        self.validators = validators
+        return data
+
+    def _debug(self):
+        if DEBUG:
+            print("loading " + self.get_full_url())
+            if self.data:
+                print("  " + self.data.decode())
+
+    def _raise_http_error(self, e):
+        if e.httperrno == 429:
+            # rate limited, keep the HTTP error so it may be retried
+            raise e
+        try:
+            # try to load whatever was returned
+            data = json.loads(e.response)
+        except:
+            # cannot parse json, just raise existing error
             raise e
-        handle_status(data, url)
+        else:
+            # response parsed, try to raise error from TMDB
+            handle_status(data, self.get_full_url())
+        # no error from TMDB, just raise existing error
+        raise e
+
+    def _process(self, data):
+        handle_status(data, self.get_full_url())
         if DEBUG:
             import pprint
 
@@ -181,6 +497,11 @@ status_handlers = {
     15: TMDBError("Failed"),
     16: TMDBError("Device Denied"),
     17: TMDBError("Session Denied"),
+    34: TMDBRequestInvalid("The resource you requested could not be found."),
+    25: TMDBRequestError(
+        "Request count over limit - Your request count is over the "
+        "allowed limit."
+    ),
 }
 
 
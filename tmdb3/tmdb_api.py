@@ -463,6 +463,11 @@ class Person(Element):
     )
     profiles = Datalist("profiles", handler=Profile, poller=_populate_images)
 
+    _append_to_response = {
+        "credits": "_populate_credits",
+        "images": "_populate_images",
+    }
+
 
 class Cast(Person):
     character = Datapoint("character")
@@ -619,9 +624,7 @@ class Language(NameRepr, Element):
 class Movie(Element):
     @classmethod
     def latest(cls):
-        req = Request("latest/movie")
-        req.lifetime = 600
-        return cls(raw=req.readJSON())
+        return cls(raw=Request("latest/movie").readJSON())
 
     @classmethod
     def nowplaying(cls, locale=None):
@@ -794,6 +797,16 @@ class Movie(Element):
         "translations", handler=Translation, poller=_populate_translations
     )
 
+    _append_to_response = {
+        "alternative_titles": "_populate_titles",
+        "casts": "_populate_cast",
+        "images": "_populate_images",
+        "keywords": "_populate_keywords",
+        "releases": "_populate_releases",
+        "trailers": "_populate_trailers",
+        "translations": "_populate_translations",
+    }
+
     def setFavorite(self, value):
         req = Request(
             "account/{0}/favorite".format(Account(session=self._session).id),
@@ -985,6 +998,12 @@ class Episode(NameRepr, Element):
         "stills", handler=Backdrop, poller=_populate_images, sort=True
     )
 
+    _append_to_response = {
+        "credits": "_populate_cast",
+        "external_ids": "_populate_external_ids",
+        "images": "_populate_images",
+    }
+
 
 class Season(NameRepr, Element):
     season_number = Datapoint("season_number", initarg=2)
@@ -1033,6 +1052,11 @@ class Season(NameRepr, Element):
     tvdb_id = Datapoint("tvdb_id", poller=_populate_external_ids)
     tvrage_id = Datapoint("tvrage_id", poller=_populate_external_ids)
 
+    _append_to_response = {
+        "external_ids": "_populate_external_ids",
+        "images": "_populate_images",
+    }
+
 
 class Series(NameRepr, Element):
     id = Datapoint("id", initarg=1)
@@ -1100,6 +1124,13 @@ class Series(NameRepr, Element):
     tvdb_id = Datapoint("tvdb_id", poller=_populate_external_ids)
     tvrage_id = Datapoint("tvrage_id", poller=_populate_external_ids)
 
+    _append_to_response = {
+        "credits": "_populate_cast",
+        "external_ids": "_populate_external_ids",
+        "images": "_populate_images",
+        "keywords": "_populate_keywords",
+    }
+
     def getSimilar(self):
         return self.similar
 
@@ -95,6 +95,7 @@ class TMDBImageSizeError(TMDBError):
 class TMDBHTTPError(TMDBError):
     def __init__(self, err):
         self.httperrno = err.code
+        self.headers = err.headers
         self.response = err.fp.read()
         super(TMDBHTTPError, self).__init__(str(err))
 
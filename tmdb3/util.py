@@ -7,6 +7,8 @@
 # -----------------------
 
 from copy import copy
+import asyncio
+
 from .locales import get_locale
 from .tmdb_auth import get_session
 
@@ -29,6 +31,11 @@ class SearchRepr(object):
         return f"<Search Results: {name}>"
 
 
+def _locale_args(req):
+    # the locale a request is made in
+    return (req._kwargs.get("language"), req._kwargs.get("country"))
+
+
 class Poller(object):
     """
     Wrapper for an optional callable to populate an Element derived
@@ -60,35 +67,86 @@ class Poller(object):
             func = self.func.__get__(inst, owner)
         return self.__class__(func, self.lookup, inst)
 
-    def __call__(self):
+    def __call__(self, append=None):
         # retrieve data from callable function, and apply
+        # optionally fold the queries of other pollers into the same
+        # request, using the append_to_response argument, where `append`
+        # maps the appended keys to the Pollers their data is routed to.
+        # those that cannot be folded are run on their own
+        append, separate = self.fold(append)
+        self._poll(append)
+        for poller in separate.values():
+            poller()
+
+    def _poll(self, append):
+        reqs = self.requests(append)
+        req = reqs[0]
+        if len(reqs) > 1:
+            # request specifies a locale filter, and fallthrough is enabled
+            # run a first pass with specified filter
+            if not self.apply(req.readJSON(), False, append):
+                return
+            # if first pass results in missed data, run a second pass to
+            # fill in the gaps
+            self.apply(reqs[1].readJSON(), append=append)
+            # re-apply the filtered first pass data over top the second
+            # unfiltered set. this is to work around the issue that the
+            # properties have no way of knowing when they should or
+            # should not overwrite existing data. the cache engine will
+            # take care of the duplicate query
+        self.apply(req.readJSON(), append=append)
+
+    def requests(self, append=None):
+        # the requests a call may run, the filtered first pass followed by
+        # the unfiltered second pass where locale fallthrough applies
         if not callable(self.func):
             raise RuntimeError(
                 "Poller object called without a source function"
             )
         req = self.func()
+        if append:
+            req = req.new(append_to_response=",".join(sorted(append)))
         if (
             ("language" in req._kwargs)
             or ("country" in req._kwargs)
             and self.inst._locale.fallthrough
         ):
-            # request specifies a locale filter, and fallthrough is enabled
-            # run a first pass with specified filter
-            if not self.apply(req.readJSON(), False):
+            return [req, req.new(language=None, country=None)]
+        return [req]
+
+    def fold(self, append=None):
+        # split the pollers to append into those folded into this query,
+        # and those to run on their own. the API applies the locale of the
+        # main query to appended resources, so only those queried in the
+        # same locale are folded, to get the same data as when run alone
+        folded, separate = {}, {}
+        if append and callable(self.func):
+            locale = _locale_args(self.func())
+            for key, poller in append.items():
+                if _locale_args(poller.func()) == locale:
+                    folded[key] = poller
+                else:
+                    separate[key] = poller
+        return folded, separate
+
+    async def call_async(self):
+        # awaitable counterpart of __call__, querying without blocking the
+        # event loop
+        reqs = self.requests()
+        req = reqs[0]
+        if len(reqs) > 1:
+            if not self.apply(await req.readJSONAsync(), False):
                 return
-            # if first pass results in missed data, run a second pass to
-            # fill in the gaps
-            self.apply(req.new(language=None, country=None).readJSON())
-            # re-apply the filtered first pass data over top the second
-            # unfiltered set. this is to work around the issue that the
-            # properties have no way of knowing when they should or
-            # should not overwrite existing data. the cache engine will
-            # take care of the duplicate query
-        self.apply(req.readJSON())
+            self.apply(await reqs[1].readJSONAsync())
+        self.apply(await req.readJSONAsync())
 
-    def apply(self, data, set_nones=True):
+    def apply(self, data, set_nones=True, append=None):
         # apply data directly, bypassing callable function
         unfilled = False
+        for key, poller in list((append or {}).items()):
+            # route appended sub-documents to the Poller they belong to
+            if key in data:
+                unfilled = poller.apply(data[key], set_nones) or unfilled
         for k, v in list(self.lookup.items()):
             if (k in data) and (
                 not callable(self.func) or data[k] is not None
@@ -443,8 +501,73 @@ class ElementType(type):
                 setattr(obj, a, v)
 
         obj.__init__()
+        if kwargs.get("prefetch"):
+            obj.prefetch(*kwargs["prefetch"])
         return obj
 
 
+def get_pollers(cls, fields=None):
+    """
+    Return the names of the pollers needed to populate the given fields of
+    an Element class, or every poller of the class if no fields are given.
+    Fields may also name a poller directly, by the suffix of its name, such
+    as 'images' for '_populate_images'.
+    """
+    if fields is None:
+        names = set()
+        for name in dir(cls):
+            attr = getattr(cls, name)
+            if isinstance(attr, Poller) and callable(attr.func):
+                names.add(name)
+        return sorted(names)
+
+    names = []
+    for field in fields:
+        attr = getattr(cls, field, None)
+        if isinstance(attr, Data):
+            name = attr.poller.__name__
+        elif isinstance(getattr(cls, f"_populate_{field}", None), Poller):
+            name = f"_populate_{field}"
+        else:
+            raise TypeError(f"'{field}' is not a data field of {cls.__name__}")
+        if name not in names:
+            names.append(name)
+    return names
+
+
 class Element(object, metaclass=ElementType):
     _lang = "en"
+    # maps the append_to_response keys supported by the element's main
+    # query to the names of the pollers otherwise used to query them
+    _append_to_response = {}
+
+    def prefetch(self, *names):
+        """
+        Populate the element along with the named sub-resources, such as
+        'images', in a single query using append_to_response. Those queried
+        in another locale than the element, to which the API would apply
+        the locale of the element, are queried on their own.
+        """
+        append = {}
+        for name in names:
+            if name not in self._append_to_response:
+                raise TypeError(
+                    f"'{name}' cannot be prefetched for "
+                    f"{self.__class__.__name__}"
+                )
+            append[name] = getattr(self, self._append_to_response[name])
+        self._populate(append)
+        return self
+
+    async def load(self, *fields):
+        """
+        Populate the given data fields, or all of them if none are given,
+        querying concurrently without blocking the event loop.
+        """
+        pollers = []
+        for name in get_pollers(self.__class__, fields or None):
+            poller = getattr(self, name)
+            if not all(field in self._data for field in poller.lookup):
+                pollers.append(poller.call_async())
+        await asyncio.gather(*pollers)
+        return self